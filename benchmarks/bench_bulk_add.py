@@ -0,0 +1,42 @@
+"""
+Benchmark for bulk imports
+adds thousands of tiny entries to a COMBINE archive with each flush policy
+and packs it. The gain depends on the cost of a write call, it is largest
+on network file systems
+"""
+import os
+import sys
+import shutil
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from combinearchive.combinearchive import CombineArchive
+
+ENTRIES = 10000
+POLICIES = (('member', CombineArchive.FLUSH_MEMBER, None),
+            ('commit', CombineArchive.FLUSH_COMMIT, 1 << 20))
+
+
+def main():
+    directory = tempfile.mkdtemp()
+    print('{:>8} {:>10} {:>12} {:>10}'.format('policy', 'add [s]', 'entries/s', 'pack [s]'))
+    try:
+        for name, policy, buffer_size in POLICIES:
+            location = os.path.join(directory, '{}.omex'.format(name))
+            start = time.time()
+            archive = CombineArchive(location, flush_policy=policy, buffer_size=buffer_size)
+            for i in range(ENTRIES):
+                archive.add_entry('entry {}'.format(i), 'text/plain', 'data/{}.txt'.format(i))
+            duration = time.time() - start
+            start = time.time()
+            archive.pack()
+            archive.close()
+            pack = time.time() - start
+            print('{:>8} {:>10.2f} {:>12.0f} {:>10.2f}'.format(name, duration, ENTRIES / duration, pack))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
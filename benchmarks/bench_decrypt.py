@@ -0,0 +1,38 @@
+"""
+Benchmark for the decryption of ZipCrypto encrypted members
+compares decrypting byte by byte with decrypting whole chunks
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from combinearchive import custom_zip as zipfile
+
+SIZE = 1 << 20
+REPEAT = 5
+
+
+def bytewise(data):
+    zd = zipfile._ZipDecrypter(b'password')
+    return ''.join(chr(c) for c in map(zd, data))
+
+
+def bulk(data):
+    zd = zipfile._ZipDecrypter(b'password')
+    return zd.decrypt(data)
+
+
+def main():
+    data = os.urandom(SIZE)
+    assert bytewise(data) == bulk(data)
+    print('{:>10} {:>10} {:>10}'.format('method', 'time [s]', 'MB/s'))
+    results = dict()
+    for func in (bytewise, bulk):
+        results[func] = min(timeit.repeat(lambda: func(data), number=1, repeat=REPEAT))
+        print('{:>10} {:>10.3f} {:>10.2f}'.format(func.__name__, results[func], SIZE / results[func] / (1 << 20)))
+    print('speedup: {:.1f}x'.format(results[bytewise] / results[bulk]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+"""
+Benchmark for ZipFile.extractall()
+extracts an archive with thousands of small files with a growing number of threads
+"""
+import os
+import sys
+import shutil
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from combinearchive import custom_zip as zipfile
+
+FILES = 5000
+FILE_SIZE = 16 * 1024
+WORKERS = (1, 2, 4, 8)
+REPEAT = 3
+
+
+def main():
+    directory = tempfile.mkdtemp()
+    archive = os.path.join(directory, 'archive.zip')
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for x in range(FILES):
+            zf.writestr('run{}/file{}.csv'.format(x % 50, x), os.urandom(FILE_SIZE // 2) * 2)
+
+    def extract(workers):
+        target = tempfile.mkdtemp(dir=directory)
+        with zipfile.ZipFile(archive, 'r') as zf:
+            zf.extractall(target, workers=workers)
+        shutil.rmtree(target)
+
+    print('{:>8} {:>10} {:>12}'.format('workers', 'time [s]', 'files/s'))
+    try:
+        for workers in WORKERS:
+            duration = min(timeit.repeat(lambda: extract(workers), number=1, repeat=REPEAT))
+            print('{:>8} {:>10.2f} {:>12.0f}'.format(workers, duration, FILES / duration))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Benchmark for the I/O hints of ZipFile
+scans an archive of the given size in MB (default 512) with testzip() in a
+background thread, while the main thread keeps reading the members of a
+small archive. Prints the read latency of the small archive and the
+throughput of the scan without and with io_hints and drop_cache
+"""
+import os
+import sys
+import time
+import threading
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from combinearchive import custom_zip as zipfile
+
+CHUNK = 1 << 20
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def create(large, small, size):
+    with zipfile.ZipFile(large, 'w') as zf:
+        for x in range(size // (16 * CHUNK) or 1):
+            zf.writestr('chunk%d.bin' % x, os.urandom(16 * CHUNK))
+    with zipfile.ZipFile(small, 'w') as zf:
+        for x in range(100):
+            zf.writestr('hot%d.bin' % x, os.urandom(64 << 10))
+
+
+def run(large, small, size, io_hints):
+    latencies = []
+    done = threading.Event()
+    result = {}
+
+    def scan():
+        start = time.time()
+        with zipfile.ZipFile(large, 'r', io_hints=io_hints, drop_cache=io_hints) as zf:
+            assert zf.testzip() is None
+        result['duration'] = time.time() - start
+        done.set()
+
+    thread = threading.Thread(target=scan)
+    thread.start()
+    with zipfile.ZipFile(small, 'r', io_hints=io_hints) as zf:
+        names = zf.namelist()
+        while not done.is_set():
+            for name in names:
+                start = time.time()
+                zf.read(name)
+                latencies.append((time.time() - start) * 1000)
+    thread.join()
+    print('{:>8} {:>12.2f} {:>12.2f} {:>10.1f}'.format(
+        'on' if io_hints else 'off', percentile(latencies, 0.5), percentile(latencies, 0.99),
+        size / result['duration'] / CHUNK))
+
+
+def main():
+    size = int(float(sys.argv[1] if len(sys.argv) > 1 else 512) * CHUNK)
+    directory = tempfile.mkdtemp()
+    large = os.path.join(directory, 'large.zip')
+    small = os.path.join(directory, 'small.zip')
+    if zipfile._fadvise is None:
+        print('posix_fadvise is not available, the hints have no effect')
+
+    print('{:>8} {:>12} {:>12} {:>10}'.format('hints', 'p50 [ms]', 'p99 [ms]', 'scan MB/s'))
+    try:
+        create(large, small, size)
+        for io_hints in (False, True):
+            run(large, small, size, io_hints)
+    finally:
+        os.remove(large)
+        os.remove(small)
+        os.rmdir(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+Benchmark for reading huge manifests
+opens a COMBINE archive with the given number of entries (default 100000)
+read-only, once with the previous reader, which builds the whole DOM of the
+manifest, and once with the streaming reader. Each run happens in a forked
+process, which reports the time and the growth of its peak memory
+"""
+import os
+import sys
+import time
+import shutil
+import resource
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from combinearchive import custom_zip as zipfile
+from combinearchive import combinearchive, exceptions, utils
+from combinearchive.combinearchive import CombineArchive, ArchiveEntry, ElementTree, _XML_NS
+
+
+class DomCombineArchive(CombineArchive):
+    """COMBINE archive with the previous manifest reader, for comparison"""
+
+    def _read_manifest(self):
+        try:
+            with self._zip.open(self.MANIFEST_LOCATION) as manifest_file:
+                manifest = ElementTree.fromstring(manifest_file.read())
+        except KeyError:
+            return False
+
+        if manifest.tag != utils.extend_tag_name(combinearchive._XML_ROOT_ELEM, _XML_NS):
+            raise exceptions.CombineArchiveException('manifest has no valid omex root element')
+
+        for entry in manifest.findall(combinearchive._XML_CONTENT_TAG, _XML_NS):
+            location = utils.get_attribute(entry, combinearchive._XML_CONTENT_LOCATION, _XML_NS)
+            entry_format = utils._check_format(utils.get_attribute(entry, combinearchive._XML_CONTENT_FORMAT, _XML_NS),
+                                               convert=False)
+            master = True if entry.attrib.get(combinearchive._XML_CONTENT_MASTER, False) in ('True', 'true', True) else False
+            location = utils.clean_pathname(location)
+            zipinfo = None
+            if location not in self.ARCHIVE_REFERENCE:
+                zipinfo = self._zip.getinfo(location)
+            self.entries[location] = ArchiveEntry(location, format=entry_format, master=master, archive=self,
+                                                  zipinfo=zipinfo)
+
+
+def create(location, count):
+    contents = ['<content location="." format="http://identifiers.org/combine.specifications/omex"/>']
+    with zipfile.ZipFile(location, 'w', flush_policy=zipfile.FLUSH_COMMIT) as zf:
+        for i in range(count):
+            name = 'data/{}.txt'.format(i)
+            zf.writestr(name, b'')
+            contents.append('<content location="./{}" format="http://purl.org/NET/mediatypes/text/plain"/>'.format(name))
+        zf.writestr('manifest.xml', '<?xml version="1.0" encoding="utf-8"?>\n'
+                    '<omexManifest xmlns="http://identifiers.org/combine.specifications/omex-manifest">\n  {}\n'
+                    '</omexManifest>\n'.format('\n  '.join(contents)))
+
+
+def measure(cls, location):
+    """open the archive in a child process and return time and memory growth"""
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        archive = cls(location, mode='r')
+        duration = time.time() - start
+        growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+        archive.close()
+        os.write(write_fd, '{} {}'.format(duration, growth).encode('ascii'))
+        os._exit(0)
+    os.close(write_fd)
+    result = os.read(read_fd, 100).decode('ascii').split()
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    return float(result[0]), int(result[1]) / 1024.0
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    directory = tempfile.mkdtemp()
+    location = os.path.join(directory, 'archive.omex')
+    try:
+        create(location, count)
+        print('{:>8} {:>10} {:>16}'.format('reader', 'open [s]', 'peak growth [MB]'))
+        for name, cls in (('dom', DomCombineArchive), ('stream', CombineArchive)):
+            duration, growth = measure(cls, location)
+            print('{:>8} {:>10.2f} {:>16.1f}'.format(name, duration, growth))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""
+Benchmark for CombineArchive.pack()
+measures the time of a single pack() with a changed description for archives
+with a fixed number of entries of growing size, once for each manifest/metadata
+layout and once for a full rewrite of the archive with repack() as baseline
+"""
+import os
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from combinearchive import combinearchive, metadata
+
+ENTRIES = 20
+SIZES = (64 * 1024, 1024 * 1024, 8 * 1024 * 1024)
+REPEAT = 5
+REWRITE = 'rewrite'
+
+
+def create_archive(entry_size, layout):
+    """
+    creates a temporary archive with ENTRIES random entries of the given size
+    """
+    name = tempfile.NamedTemporaryFile(suffix='.omex', delete=False).name
+    os.remove(name)
+    archive = combinearchive.CombineArchive(name, layout=layout)
+    for x in range(ENTRIES):
+        archive.add_entry(os.urandom(entry_size), 'text/plain', 'data/{}.bin'.format(x))
+    archive.repack()
+    return name, archive
+
+
+def bench(entry_size, layout):
+    name, archive = create_archive(entry_size, combinearchive.CombineArchive.LAYOUT_INPLACE
+                                   if layout == REWRITE else layout)
+    counter = [0]
+
+    def pack():
+        counter[0] += 1
+        archive.add_description(metadata.OmexMetaDataObject(description='change {}'.format(counter[0])))
+        if layout == REWRITE:
+            archive.repack()
+        else:
+            archive.pack()
+
+    try:
+        return min(timeit.repeat(pack, number=1, repeat=REPEAT))
+    finally:
+        archive.close()
+        os.remove(name)
+
+
+def main():
+    print('{} entries each'.format(ENTRIES))
+    print('{:>12} {:>10} {:>12}'.format('archive [MB]', 'layout', 'pack [ms]'))
+    for entry_size in SIZES:
+        for layout in (REWRITE, combinearchive.CombineArchive.LAYOUT_INPLACE,
+                       combinearchive.CombineArchive.LAYOUT_TAIL):
+            print('{:>12.1f} {:>10} {:>12.2f}'.format(ENTRIES * entry_size / float(1 << 20), layout,
+                                                       bench(entry_size, layout) * 1000))
+
+
+if __name__ == '__main__':
+    main()
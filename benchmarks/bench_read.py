@@ -0,0 +1,52 @@
+"""
+Benchmark for the CRC verification policies
+reads all members of an archive with many medium sized files, checking their
+CRC while reading, not at all or deferred in a background thread.
+'read' is the time until all members are read, 'total' includes close(),
+which waits for the deferred checks
+"""
+import os
+import sys
+import shutil
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from combinearchive import custom_zip as zipfile
+
+FILES = 500
+FILE_SIZE = 256 * 1024
+POLICIES = (('always', zipfile.VERIFY_ALWAYS),
+            ('never', zipfile.VERIFY_NEVER),
+            ('deferred', zipfile.VERIFY_DEFERRED))
+REPEAT = 3
+
+
+def main():
+    directory = tempfile.mkdtemp()
+    archive = os.path.join(directory, 'archive.zip')
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_STORED) as zf:
+        for x in range(FILES):
+            zf.writestr('file{}.bin'.format(x), os.urandom(FILE_SIZE))
+
+    def read(policy):
+        start = time.time()
+        zf = zipfile.ZipFile(archive, 'r', verify_crc=policy)
+        for name in zf.namelist():
+            zf.read(name)
+        read_done = time.time()
+        zf.close()
+        return read_done - start, time.time() - start
+
+    size = FILES * FILE_SIZE
+    print('{:>10} {:>10} {:>10} {:>10}'.format('policy', 'read [s]', 'MB/s', 'total [s]'))
+    try:
+        for name, policy in POLICIES:
+            duration, total = min(read(policy) for _ in range(REPEAT))
+            print('{:>10} {:>10.3f} {:>10.1f} {:>10.3f}'.format(name, duration, size / duration / (1 << 20), total))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
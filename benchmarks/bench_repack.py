@@ -0,0 +1,86 @@
+"""
+Benchmark for copying all members into a new archive, as repack() does
+copies an archive with deflated members of the given size in MB (default
+256) once by reading and writing each member like the previous repack(),
+once raw with copy_from() and once with copy_from() changing the compression
+to ZIP_STORED. Each run happens in a forked process, which reports the time
+and the growth of its peak memory
+"""
+import os
+import sys
+import time
+import shutil
+import resource
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from combinearchive import custom_zip as zipfile
+
+CHUNK = 1 << 20
+
+
+def create(location, size):
+    # in a child process, so its memory use does not hide the one of the copies
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return
+    with zipfile.ZipFile(location, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for x in range(size // (8 * CHUNK) or 1):
+            # compresses to about half of the size
+            zf.writestr('chunk%d.bin' % x, os.urandom(4 * CHUNK).encode('hex'))
+        zf.writestr('large.bin', os.urandom(size // 4).encode('hex'))
+    os._exit(0)
+
+
+def read_write(source, target):
+    for zinfo in source.infolist():
+        target.writestr(zinfo, source.read(zinfo))
+
+
+def raw(source, target):
+    target.copy_from(source)
+
+
+def stored(source, target):
+    target.copy_from(source, compress_type=zipfile.ZIP_STORED)
+
+
+def measure(copy, location, target):
+    """copy the archive in a child process and return time and memory growth"""
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        with zipfile.ZipFile(location, 'r') as source, zipfile.ZipFile(target, 'w') as zf:
+            copy(source, zf)
+        duration = time.time() - start
+        growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+        os.write(write_fd, '{} {}'.format(duration, growth).encode('ascii'))
+        os._exit(0)
+    os.close(write_fd)
+    result = os.read(read_fd, 100).decode('ascii').split()
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    return float(result[0]), int(result[1]) / 1024.0
+
+
+def main():
+    size = int(float(sys.argv[1] if len(sys.argv) > 1 else 256) * CHUNK)
+    directory = tempfile.mkdtemp()
+    location = os.path.join(directory, 'archive.zip')
+    target = os.path.join(directory, 'copy.zip')
+    try:
+        create(location, size)
+        print('{:>12} {:>10} {:>16}'.format('copy', 'time [s]', 'peak growth [MB]'))
+        for name, copy in (('read/write', read_write), ('raw', raw), ('stored', stored)):
+            duration, growth = measure(copy, location, target)
+            print('{:>12} {:>10.2f} {:>16.1f}'.format(name, duration, growth))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
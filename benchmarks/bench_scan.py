@@ -0,0 +1,61 @@
+"""
+Benchmark for full scans of an archive with many small files
+reads all members in random order with read(), in the order of their
+offsets with read(), and with iter_members(), which fetches neighbouring
+members with a single read
+"""
+import os
+import sys
+import random
+import shutil
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from combinearchive import custom_zip as zipfile
+
+FILES = 20000
+FILE_SIZE = 2048
+REPEAT = 3
+
+
+def main():
+    directory = tempfile.mkdtemp()
+    archive = os.path.join(directory, 'archive.zip')
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for x in range(FILES):
+            zf.writestr('file{}.txt'.format(x), os.urandom(FILE_SIZE // 2).encode('hex'))
+
+    def random_order(zf):
+        names = zf.namelist()
+        random.shuffle(names)
+        for name in names:
+            zf.read(name)
+
+    def offset_order(zf):
+        for zinfo in sorted(zf.infolist(), key=lambda x: x.header_offset):
+            zf.read(zinfo)
+
+    def iter_members(zf):
+        for zinfo, data in zf.iter_members():
+            pass
+
+    def measure(scan):
+        with zipfile.ZipFile(archive, 'r') as zf:
+            start = time.time()
+            scan(zf)
+            return time.time() - start
+
+    size = FILES * FILE_SIZE
+    print('{:>14} {:>10} {:>10}'.format('scan', 'time [s]', 'MB/s'))
+    try:
+        for name, scan in (('random read', random_order), ('ordered read', offset_order),
+                           ('iter_members', iter_members)):
+            duration = min(measure(scan) for _ in range(REPEAT))
+            print('{:>14} {:>10.3f} {:>10.1f}'.format(name, duration, size / duration / (1 << 20)))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
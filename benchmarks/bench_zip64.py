@@ -0,0 +1,62 @@
+"""
+Benchmark for large ZIP64 archives
+writes a member from a sparse file of the given size in GB (default 5) into
+a new archive, reads it back and removes a member in front of it.
+Prints the throughput of each step and the peak memory of the process
+"""
+import os
+import sys
+import time
+import resource
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from combinearchive import custom_zip as zipfile
+
+
+def max_rss():
+    """peak resident memory of this process in MB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def measure(name, size, func):
+    start = time.time()
+    func()
+    duration = time.time() - start
+    print('{:>8} {:>10.1f} {:>10.1f} {:>12.1f}'.format(name, duration, size / duration / (1 << 20), max_rss()))
+
+
+def main():
+    size = int(float(sys.argv[1] if len(sys.argv) > 1 else 5) * (1 << 30))
+    directory = tempfile.mkdtemp()
+    source = os.path.join(directory, 'source.bin')
+    archive = os.path.join(directory, 'archive.zip')
+    with open(source, 'wb') as fp:
+        fp.truncate(size)
+
+    def write():
+        with zipfile.ZipFile(archive, 'w') as zf:
+            zf.writestr('first', b'first')
+            zf.write(source, 'large')
+
+    def read():
+        with zipfile.ZipFile(archive, 'r') as zf:
+            assert zf.testzip() is None
+
+    def remove():
+        with zipfile.ZipFile(archive, 'a') as zf:
+            zf.remove('first')
+
+    print('{:>8} {:>10} {:>10} {:>12}'.format('step', 'time [s]', 'MB/s', 'peak RSS [MB]'))
+    try:
+        measure('write', size, write)
+        measure('read', size, read)
+        measure('remove', size, remove)
+    finally:
+        os.remove(source)
+        os.remove(archive)
+        os.rmdir(directory)
+
+
+if __name__ == '__main__':
+    main()
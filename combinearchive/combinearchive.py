@@ -2,10 +2,17 @@ import os
 import shutil
 import tempfile
 import re
+import threading
 from StringIO import StringIO
+from io import BytesIO
 # import zipfile
 import custom_zip as zipfile
 from xml.etree import ElementTree
+try:
+    # the C implementation parses large manifests much faster
+    from xml.etree import cElementTree as ElementParser
+except ImportError:
+    ElementParser = ElementTree
 try:
     # Python 3
     from urllib.parse import urlparse, urljoin
@@ -39,6 +46,20 @@ for prefix, url in _XML_NS.items():
     ElementTree.register_namespace(prefix, url)
 
 
+def _is_readable(fileobj):
+    """
+    checks, if the file object can be read as well
+    """
+    if not hasattr(fileobj, 'read'):
+        return False
+    readable = getattr(fileobj, 'readable', None)
+    if readable is not None:
+        return readable()
+    # file objects of Python 2 only have a mode, StringIO not even that
+    mode = getattr(fileobj, 'mode', 'r+b')
+    return 'r' in mode or '+' in mode
+
+
 class CombineArchive(metadata.MetaDataHolder):
     """
     base class for reading, creating and modifying COMBINE Archives
@@ -48,60 +69,362 @@ class CombineArchive(metadata.MetaDataHolder):
     METADATA_LOCATION = 'metadata.rdf'
     # paths used in the manifest to assign meta data to the archive itself
     ARCHIVE_REFERENCE = ('.', '/')
+    # layouts for manifest and metadata:
+    # written with reserved space and overwritten in place, if possible
+    LAYOUT_INPLACE = 'inplace'
+    # always the last entries of the archive, so they are just cut off and appended again
+    LAYOUT_TAIL = 'tail'
+    # durability levels of changes, see custom_zip.ZipFile
+    DURABILITY_NONE = zipfile.DURABILITY_NONE
+    DURABILITY_FSYNC = zipfile.DURABILITY_FSYNC
+    DURABILITY_JOURNAL = zipfile.DURABILITY_JOURNAL
+    VERIFY_ALWAYS = zipfile.VERIFY_ALWAYS
+    VERIFY_NEVER = zipfile.VERIFY_NEVER
+    VERIFY_DEFERRED = zipfile.VERIFY_DEFERRED
+    FLUSH_MEMBER = zipfile.FLUSH_MEMBER
+    FLUSH_COMMIT = zipfile.FLUSH_COMMIT
+    FLUSH_NEVER = zipfile.FLUSH_NEVER
+    # compression of entries, see repack()
+    ZIP_STORED = zipfile.ZIP_STORED
+    ZIP_DEFLATED = zipfile.ZIP_DEFLATED
 
-    def __init__(self, archive):
+    def __init__(self, archive, preload_headers=False, reuse_space=False, reserve=1024, layout=LAYOUT_INPLACE,
+                 durability=DURABILITY_NONE, verify_crc=VERIFY_ALWAYS, on_crc_error=None,
+                 flush_policy=FLUSH_MEMBER, buffer_size=None, io_hints=False, drop_cache=False, mode='a'):
+        """
+        opens the COMBINE archive at the given path or file-like object.
+        With archive=None a new archive is created in memory, see getvalue().
+        With preload_headers=True all local file headers are validated on open,
+        so subsequent reads of an entry need just one seek.
+        With reuse_space=True removed or replaced entries (including the manifest)
+        leave holes, which are filled by entries added later on, instead of
+        shifting all following entries.
+        reserve is the number of bytes kept free behind the manifest and the metadata,
+        so that updated versions of them can be written in place.
+        layout=LAYOUT_TAIL keeps manifest and metadata behind all other entries instead,
+        so pack() never moves any other entry. It cannot be combined with reuse_space.
+        durability=DURABILITY_FSYNC or DURABILITY_JOURNAL keeps the archive readable
+        if the process crashes while it is modified, at the cost of some fsync calls
+        and of space, which is only reclaimed with reuse_space or repack()
+        verify_crc=VERIFY_NEVER skips the CRC check, when entries are read.
+        VERIFY_DEFERRED checks them in a background thread instead. Bad entries are
+        passed to on_crc_error or raise a BadZipFile on the next read or on close().
+        verify() always checks all entries
+        flush_policy=FLUSH_COMMIT keeps added entries in a write buffer of buffer_size bytes
+        until the next pack(), instead of flushing the file after each one. Use it for bulk imports
+        io_hints=True tells the kernel about sequential reads and reads opened entries ahead.
+        drop_cache=True drops the pages read by verify() and repack() from the page cache afterwards,
+        so a large archive does not push the data of other readers out of it. This affects all readers
+        of the archive, including concurrent ones
+        mode='r' opens the archive read-only, so every modification raises a CombineArchiveException.
+        A read-only archive opened from a path can be shared by threads and forked processes.
+        The metadata is read on the first access to the description of the archive or of any entry
+        """
+        self._metadata_lock = threading.RLock()
+        self._metadata_loaded = False
+        self._metadata_loading = False
+        self._metadata_changed = False
+        self._manifest_changed = False
         super(CombineArchive, self).__init__()
+        if mode not in ('r', 'a'):
+            raise exceptions.CombineArchiveException('{mode} is no valid mode'.format(mode=mode))
+        self._check_layout(layout, reuse_space)
+        self._mode = mode
+        if archive is None:
+            archive = BytesIO()
         self._archive = archive
-        self._zip = zipfile.ZipFile(archive, mode='a')
+        self._preload_headers = preload_headers
+        self._reuse_space = reuse_space
+        self._reserve = reserve
+        self._layout = layout
+        self._durability = durability
+        self._verify_crc = verify_crc
+        self._on_crc_error = on_crc_error
+        self._flush_policy = flush_policy
+        self._buffer_size = buffer_size
+        self._io_hints = io_hints
+        self._drop_cache = drop_cache
+        self._zip = self._open_zip(archive)
         self.entries = dict()
+        self._formats = dict()  # format -> {location: entry}
+        self._masters = dict()  # location -> entry with master flag
 
-        self._read_manifest()
-        self._read_metadata()
+        if not self._read_manifest():
+            # a new archive gets both main entries on the first pack()
+            self._metadata_changed = True
+            self._manifest_changed = True
+        else:
+            # reading the manifest fills the index, which is no change
+            self._manifest_changed = False
 
     def __exit__(self):
         self.close()
 
+    @property
+    def description(self):
+        self._ensure_metadata()
+        return self._description
+
+    @description.setter
+    def description(self, value):
+        # otherwise the metadata read later on is added to the new list
+        self._ensure_metadata()
+        self._set_description(value)
+
+    def _ensure_metadata(self):
+        """
+        internal function.
+        reads the metadata once, if this did not happen yet. Threads asking at the same time wait for it
+        """
+        if self._metadata_loaded:
+            return
+        with self._metadata_lock:
+            if self._metadata_loaded or self._metadata_loading:
+                # loaded meanwhile, or accessed while adding the descriptions
+                return
+            self._metadata_loading = True
+            try:
+                self._read_metadata()
+                self._metadata_loaded = True
+            except:
+                # start over on the next access
+                self._set_description([])
+                for entry in self.entries.values():
+                    entry._set_description([])
+                raise
+            finally:
+                self._metadata_loading = False
+            self._mark_all_metadata_saved()
+
+    def _mark_all_metadata_saved(self):
+        """
+        internal function.
+        marks the metadata of the archive and of all entries as unchanged
+        """
+        self._metadata_changed = False
+        self._mark_metadata_saved()
+        for entry in self.entries.values():
+            entry._mark_metadata_saved()
+
+    def _metadata_has_changes(self):
+        """
+        internal function.
+        checks, if the metadata was changed since it was read or written the last time
+        """
+        if self._metadata_changed:
+            return True
+        if not self._metadata_loaded:
+            # nobody looked at it
+            return False
+        return self._has_metadata_changes() or any(entry._has_metadata_changes() for entry in self.entries.values())
+
+    def has_changes(self):
+        """
+        checks, if the archive was modified since it was opened or packed the last time,
+        i.e. if pack() would write anything
+        """
+        return self._manifest_changed or self._zip._didModify or self._metadata_has_changes()
+
+    def _open_zip(self, archive):
+        """
+        internal function.
+        opens the underlying zip file with the options of this archive
+        """
+        if self._mode == 'r':
+            # none of the write options apply
+            return zipfile.ZipFile(archive, mode='r', preload_headers=self._preload_headers,
+                                   verify_crc=self._verify_crc, on_crc_error=self._on_crc_error,
+                                   io_hints=self._io_hints, drop_cache=self._drop_cache)
+        return zipfile.ZipFile(archive, mode='a', preload_headers=self._preload_headers,
+                               reuse_space=self._reuse_space, durability=self._durability,
+                               verify_crc=self._verify_crc, on_crc_error=self._on_crc_error,
+                               flush_policy=self._flush_policy, buffer_size=self._buffer_size,
+                               io_hints=self._io_hints, drop_cache=self._drop_cache)
+
+    def _reopen_zip(self):
+        """
+        internal function.
+        opens the underlying zip file again and points all entries to the new ZipInfo objects
+        """
+        self._zip = self._open_zip(self._archive)
+        for (location, entry) in self.entries.items():
+            entry.zipinfo = self._zip.NameToInfo.get(location)
+
+    def _check_writable(self):
+        """
+        internal function.
+        raises a CombineArchiveException, if the archive was opened read-only
+        """
+        if self._mode == 'r':
+            raise exceptions.CombineArchiveException('the COMBINE archive is opened read-only')
+
+    def _register_entry(self, entry):
+        """
+        internal function.
+        adds the entry to the entries and to the indexes of formats and master entries
+        """
+        old = self.entries.get(entry.location)
+        if old is not None:
+            self._unindex_entry(old)
+        self.entries[entry.location] = entry
+        self._index_entry(entry)
+
+    def _unregister_entry(self, location):
+        """
+        internal function.
+        removes the entry at location from the entries and from the indexes
+        """
+        entry = self.entries.pop(location)
+        self._unindex_entry(entry)
+        return entry
+
+    def _index_entry(self, entry):
+        """
+        internal function.
+        adds the entry to the indexes of formats and master entries
+        """
+        self._formats.setdefault(entry.format, dict())[entry.location] = entry
+        if entry.master is True:
+            # like the former filter, other true values do not count
+            self._masters[entry.location] = entry
+        # every change of the index is a change of the manifest
+        self._manifest_changed = True
+
+    def _unindex_entry(self, entry):
+        """
+        internal function.
+        removes the entry from the indexes of formats and master entries
+        """
+        entries = self._formats.get(entry.format)
+        if entries is not None and entries.get(entry.location) is entry:
+            del entries[entry.location]
+            if not entries:
+                del self._formats[entry.format]
+        if self._masters.get(entry.location) is entry:
+            del self._masters[entry.location]
+        self._manifest_changed = True
+
+    def _check_layout(self, layout, reuse_space):
+        """
+        internal function.
+        checks the layout option
+        """
+        if layout not in (self.LAYOUT_INPLACE, self.LAYOUT_TAIL):
+            raise exceptions.CombineArchiveException('{layout} is no valid layout'.format(layout=layout))
+        if layout == self.LAYOUT_TAIL and reuse_space:
+            raise exceptions.CombineArchiveException('the tail layout cannot be combined with reuse_space')
+
+    def _detach_tail(self):
+        """
+        internal function.
+        removes manifest and metadata from the zip file, if they are the last entries in it,
+        which does not move any other entry.
+
+        Returns:
+            list of (ZipInfo, data) tuples of the removed entries, to write them again later on
+        """
+        tail = [self._zip.NameToInfo[location] for location in (self.METADATA_LOCATION, self.MANIFEST_LOCATION)
+                if location in self._zip.NameToInfo]
+        if not tail:
+            return []
+        start = min(zipinfo.header_offset for zipinfo in tail)
+        if any(zipinfo.header_offset > start for zipinfo in self._zip.infolist() if zipinfo not in tail):
+            # there are other entries behind them
+            return []
+
+        tail.sort(key=lambda zipinfo: zipinfo.header_offset)
+        detached = [(zipinfo, self._zip.read(zipinfo)) for zipinfo in tail]
+        for zipinfo in reversed(tail):
+            self._zip.remove(zipinfo)
+        return detached
+
+    def _write_main_entry(self, zip_file, location, data):
+        """
+        internal function.
+        writes manifest or metadata according to the layout
+
+        Returns:
+            ZipInfo of the written entry
+        """
+        if self._layout == self.LAYOUT_TAIL:
+            if location in zip_file.NameToInfo:
+                zip_file.remove(location)
+            return zip_file.writestr(location, data)
+        else:
+            # overwrites the old version in place, if the new one fits
+            return zip_file.replace(location, data, reserve=self._reserve)
+
     def _read_manifest(self):
         """
         internal function.
-        Reads the manifest file of a COMBINE Archive
+        Reads the manifest file of a COMBINE Archive.
+        The manifest is parsed incrementally and every content element is dropped once its entry
+        is created, so even huge manifests are never kept in memory as a whole
         """
+        content_tag = utils.extend_tag_name(_XML_CONTENT_TAG, _XML_NS)
+        # attribute names with and without namespace, see utils.get_attribute()
+        location_ns = utils.extend_tag_name(_XML_CONTENT_LOCATION, _XML_NS)
+        location_attr = _XML_CONTENT_LOCATION.split(':')[-1]
+        format_ns = utils.extend_tag_name(_XML_CONTENT_FORMAT, _XML_NS)
+        format_attr = _XML_CONTENT_FORMAT.split(':')[-1]
+        master_ns = utils.extend_tag_name(_XML_CONTENT_MASTER, _XML_NS)
+        master_attr = _XML_CONTENT_MASTER.split(':')[-1]
+
         try:
-            with self._zip.open(self.MANIFEST_LOCATION) as manifest_file:
-                manifest = ElementTree.fromstring(manifest_file.read())
+            manifest_file = self._zip.open(self.MANIFEST_LOCATION)
         except KeyError:
             # manifest does not exists, probably an empty/new archive
             return False
-        except ElementTree.ParseError as e:
-            raise exceptions.CombineArchiveException('Cannot parse xml manifest. {}'.format(e.msg))
-
-        # check for correct root element and namespace
-        if manifest.tag != utils.extend_tag_name(_XML_ROOT_ELEM, _XML_NS):
-            raise exceptions.CombineArchiveException('manifest has no valid omex root element')
 
-        # check entries
-        for entry in manifest.findall(_XML_CONTENT_TAG, _XML_NS):
+        with manifest_file:
+            root = None
             try:
-                location = utils.get_attribute(entry, _XML_CONTENT_LOCATION, _XML_NS)
-                entry_format = utils.check_format(utils.get_attribute(entry, _XML_CONTENT_FORMAT, _XML_NS), convert=False)
-                master = True if entry.attrib.get(_XML_CONTENT_MASTER, False) in ('True', 'true', True) else False
-            except KeyError:
-                raise exceptions.CombineArchiveException('location and format field are required. Corrupt manifest.xml')
+                for (event, element) in ElementParser.iterparse(manifest_file, events=('start', 'end')):
+                    if root is None:
+                        # check for correct root element and namespace
+                        if element.tag != utils.extend_tag_name(_XML_ROOT_ELEM, _XML_NS):
+                            raise exceptions.CombineArchiveException('manifest has no valid omex root element')
+                        root = element
+                        continue
+                    if event != 'end' or element.tag != content_tag:
+                        continue
 
-            # clean location
-            location = utils.clean_pathname(location)
+                    attrib = element.attrib
+                    try:
+                        location = attrib[location_ns] if location_ns in attrib else attrib[location_attr]
+                        entry_format = attrib[format_ns] if format_ns in attrib else attrib[format_attr]
+                        entry_format = utils.check_format(entry_format, convert=False)
+                        master = attrib[master_ns] if master_ns in attrib else attrib.get(master_attr, False)
+                        master = True if master in ('True', 'true', True) else False
+                    except KeyError:
+                        raise exceptions.CombineArchiveException('location and format field are required. Corrupt manifest.xml')
+                    # the element is not needed any more
+                    root.clear()
 
-            # check if file is in zip, if it's not the root element
-            zipinfo = None
-            if location not in self.ARCHIVE_REFERENCE:
-                try:
-                    zipinfo = self._zip.getinfo(location)
-                except KeyError:
-                    raise exceptions.CombineArchiveException(
-                        '{location} is specified by the manifest, but not contained by the ZIP file'.format(location=location))
+                    self._add_manifest_entry(location, entry_format, master)
+            except (ElementParser.ParseError, ElementTree.ParseError) as e:
+                raise exceptions.CombineArchiveException('Cannot parse xml manifest. {}'.format(e.msg))
+        return True
 
-            archive_entry = ArchiveEntry(location, format=entry_format, master=master, archive=self, zipinfo=zipinfo)
-            self.entries[location] = archive_entry
+    def _add_manifest_entry(self, location, entry_format, master):
+        """
+        internal function.
+        creates the ArchiveEntry for a content element of the manifest
+        """
+        # clean location
+        location = utils.clean_pathname(location)
+
+        # check if file is in zip, if it's not the root element
+        zipinfo = None
+        if location not in self.ARCHIVE_REFERENCE:
+            try:
+                zipinfo = self._zip.getinfo(location)
+            except KeyError:
+                raise exceptions.CombineArchiveException(
+                    '{location} is specified by the manifest, but not contained by the ZIP file'.format(location=location))
+
+        archive_entry = ArchiveEntry(location, format=entry_format, master=master, archive=self, zipinfo=zipinfo)
+        self._register_entry(archive_entry)
 
     def _read_metadata(self):
 
@@ -172,14 +495,17 @@ class CombineArchive(metadata.MetaDataHolder):
         # write xml to zip
         io = StringIO()
         ElementTree.ElementTree(manifest).write(io, xml_declaration=True, default_namespace=_XML_ROOT_NS, encoding='utf-8')
-        try:
-            zip_file.remove(self.MANIFEST_LOCATION)
-        except KeyError:
-            pass  # Manifest does not exist yet, so removing it will fail
-        zip_file.writestr(self.MANIFEST_LOCATION, io.getvalue())
+        self._write_main_entry(zip_file, self.MANIFEST_LOCATION, io.getvalue())
         io.close()
+        self._manifest_changed = False
 
-    def _write_metadata(self):
+    def _write_metadata(self, zip_file=None):
+        """
+        internal function.
+        Writes the metadata file of a COMBINE Archive
+        """
+        if zip_file is None:
+            zip_file = self._zip
 
         # create new Element object for RDF
         rdf = ElementTree.Element(utils.extend_tag_name(metadata.Namespace.rdf_terms.rdf, _XML_NS))
@@ -205,9 +531,16 @@ class CombineArchive(metadata.MetaDataHolder):
         # write xml to zip
         io = StringIO()
         ElementTree.ElementTree(rdf).write(io, xml_declaration=True, encoding='utf-8')
-        self.add_entry(io.getvalue(), _XML_CONTENT_METADATA_TYPE, location=self.METADATA_LOCATION, replace=True)
+        zipinfo = self._write_main_entry(zip_file, self.METADATA_LOCATION, io.getvalue())
         io.close()
 
+        if self.METADATA_LOCATION in self.entries:
+            self.entries[self.METADATA_LOCATION].zipinfo = zipinfo
+        else:
+            self._register_entry(ArchiveEntry(self.METADATA_LOCATION, format=_XML_CONTENT_METADATA_TYPE,
+                                              zipinfo=zipinfo, archive=self))
+        self._mark_all_metadata_saved()
+
     def close(self):
         """
         closes the COMBINE Archive.
@@ -215,76 +548,160 @@ class CombineArchive(metadata.MetaDataHolder):
         """
         self._zip.close()
 
-    def repack(self, output_file=None):
+    def repack(self, output_file=None, layout=None, compression=None, workers=None, progress=None):
         """
         rewrites the COMBINE archive with all changes and metadata into a temp file and then attemps
-        to replace to original archive. Works only with archive, which really exist on the filesystem (no StringIO)
+        to replace to original archive. Archives opened from a file object are rewritten into a temp
+        file, or into memory, if they are in memory, and copied back.
+        If output_file is given, the archive is written into this file object instead, starting at its
+        current position. If it can be read as well, the COMBINE archive continues on it. Otherwise it
+        is just an export, all changes are packed into the original archive beforehand.
+        If a layout is given, the archive is converted to it
+        The entries are copied without decompressing them, unless compression is set to ZIP_STORED or
+        ZIP_DEFLATED and differs from the one of an entry. Those are compressed again by workers threads,
+        which defaults to the number of CPUs. Memory use does not depend on the size of the entries.
+        progress is called with the number of copied entries and the total number of entries
         """
-        if output_file is None:
+        self._check_writable()
+        if layout is not None:
+            self._check_layout(layout, self._reuse_space)
+        else:
+            layout = self._layout
+
+        export = output_file is not None and not _is_readable(output_file)
+        if export:
+            # the archive stays where it is, so it gets the changes first
+            self.pack()
+            metadata_entry = self.entries.get(self.METADATA_LOCATION)
+        else:
+            self._layout = layout
+
+        if output_file is not None:
+            new_file = output_file
+        elif not isinstance(self._archive, (str, unicode)):
+            # archives in memory stay there
+            new_file = BytesIO() if hasattr(self._archive, 'getvalue') else tempfile.TemporaryFile()
+        else:
             try:
                 new_file = tempfile.NamedTemporaryFile(
                     dir=os.path.dirname(self._archive), delete=False )
             except:
                 new_file = tempfile.NamedTemporaryFile(delete=False)
-        else:
-            new_file = output_file
 
-        new_zip = zipfile.ZipFile(new_file, mode='a')
+        # the new file replaces the old one only once it is complete, so no journal is needed
+        new_zip = zipfile.ZipFile(new_file, mode='w',
+                                  durability=min(self._durability, zipfile.DURABILITY_FSYNC),
+                                  flush_policy=zipfile.FLUSH_COMMIT, buffer_size=self._buffer_size)
 
-        # add main entries
-        self._write_metadata()  # write metadata first, so the ArchiveEntry is updated
-        self._write_manifest(zip_file=new_zip)
+        if layout != self.LAYOUT_TAIL:
+            # add main entries first
+            self._write_metadata(zip_file=new_zip)  # write metadata first, so the ArchiveEntry is updated
+            self._write_manifest(zip_file=new_zip)
 
-        # add all entries
+        # copy all entries, the old archive is read just once
+        members = []
         for (location, entry) in self.entries.items():
-            if location in self.ARCHIVE_REFERENCE or location == self.MANIFEST_LOCATION:
+            if location in self.ARCHIVE_REFERENCE or location in (self.MANIFEST_LOCATION, self.METADATA_LOCATION):
                 # skip root entry (representing the archive itself) and the two main entries (manifest and metadata)
                 continue
 
             if entry.zipinfo is None:
                 entry.zipinfo = self._zip.getinfo(location)
+            members.append(entry.zipinfo)
+        new_zip.copy_from(self._zip, members, compress_type=compression, workers=workers, progress=progress)
 
-            buffer = self._zip.read(entry.zipinfo)
-            new_zip.writestr(entry.zipinfo, buffer)
+        if layout == self.LAYOUT_TAIL:
+            # add main entries behind all others
+            self._write_metadata(zip_file=new_zip)
+            self._write_manifest(zip_file=new_zip)
 
-        # close both zip files
         new_zip.close()
+        if export:
+            if metadata_entry is None:
+                # only the export got a metadata file
+                self._unregister_entry(self.METADATA_LOCATION)
+                self._manifest_changed = False
+            else:
+                metadata_entry.zipinfo = self._zip.NameToInfo.get(self.METADATA_LOCATION)
+            return
         self._zip.close()
 
-        if output_file is None:
-            # remove old file and move new one
-            os.remove(self._archive)
-            shutil.move(new_file.name, self._archive)
-        else:
+        if output_file is not None:
             if not isinstance(self._archive, (str, unicode)):
                 # is a file descriptor
                 self._archive.close()
             self._archive = new_file
+        elif isinstance(self._archive, (str, unicode)):
+            # remove old file and move new one
+            os.remove(self._archive)
+            shutil.move(new_file.name, self._archive)
+        else:
+            # copy it back, so the file object stays valid
+            new_file.seek(0)
+            self._archive.seek(0)
+            shutil.copyfileobj(new_file, self._archive)
+            self._archive.truncate()
+            new_file.close()
 
         # open new zip file
-        self._zip = zipfile.ZipFile(self._archive, mode='a')
+        self._reopen_zip()
+
+    def getvalue(self):
+        """
+        returns the content of a COMBINE archive in memory, i.e. created with archive=None or opened
+        from a BytesIO object, as a string. Pending changes are packed beforehand
+        """
+        getvalue = getattr(self._archive, 'getvalue', None)
+        if getvalue is None:
+            raise exceptions.CombineArchiveException('the COMBINE archive is not in memory')
+        if self.has_changes():
+            self.pack()
+        return getvalue()
 
     def pack(self):
         """
-        writes any change of manifest or metadate into the COMBINE archive
+        writes any change of manifest or metadate into the COMBINE archive.
+        Manifest and metadata are only rewritten, if they changed. Does nothing, if has_changes() is False
         """
+        self._check_writable()
+        metadata_changed = self._metadata_has_changes()
+        if not (metadata_changed or self._manifest_changed or self._zip._didModify):
+            return
+
+        tail = []
+        if self._layout == self.LAYOUT_TAIL and (metadata_changed or self._manifest_changed):
+            # cut off manifest and metadata, if they are the last entries
+            tail = self._detach_tail()
+        unchanged = dict((zipinfo.filename, (zipinfo, data)) for (zipinfo, data) in tail)
 
-        # add main entries
-        self._write_metadata()  # write metadata first, so the ArchiveEntry is updated
-        self._write_manifest()
+        # add main entries, metadata first, so the ArchiveEntry is updated
+        metadata_entry = self.entries.get(self.METADATA_LOCATION)
+        if metadata_changed or (self.METADATA_LOCATION in unchanged and metadata_entry is None):
+            # a metadata file missing in the manifest is written fresh and added to it
+            self._write_metadata()
+        elif self.METADATA_LOCATION in unchanged:
+            # just put the detached version back
+            metadata_entry.zipinfo = self._zip.writestr(*unchanged[self.METADATA_LOCATION])
+        if self._manifest_changed:
+            self._write_manifest()
+        elif self.MANIFEST_LOCATION in unchanged:
+            self._zip.writestr(*unchanged[self.MANIFEST_LOCATION])
 
         # close and reopen zipfile, so the zip dictionary gots written
         self._zip.close()
-        self._zip = zipfile.ZipFile(self._archive, mode='a')
+        self._reopen_zip()
 
-    def add_entry(self, file, format, location=None, master=False, replace=False):
+    def add_entry(self, file, format, location=None, master=False, replace=False, align=0):
         """
         adds a file-like object to the COMBINE archive and adds a manifest entry
         if file is an instance of unicode or str, the content of this variable is written as content
+        with align=4096 the content starts on a memory page, so ArchiveEntry.mmap() maps it directly.
+        The alignment gets lost, if the entry is moved later on, e.g. by removing an entry in front of it
 
         Returns:
             ArchiveEntry
         """
+        self._check_writable()
         if not file or not format:
             raise exceptions.CombineArchiveException('both a file and the corresponding format must be provided')
         # check format schema
@@ -300,21 +717,29 @@ class CombineArchive(metadata.MetaDataHolder):
         if location == self.MANIFEST_LOCATION or location in self.ARCHIVE_REFERENCE:
             raise exceptions.CombineArchiveException('it is not allowed to name a file {loc}'.format(loc=location))
 
-        if location in self._zip.namelist():
+        if location in self._zip.NameToInfo:
             if replace is False:
                 raise exceptions.CombineArchiveException('{loc} exists already in the COMBINE archive. set replace=True, to override it'.format(loc=location))
             else:
                 self.remove_entry(location)
 
+        tail = []
+        if self._layout == self.LAYOUT_TAIL:
+            # new entries go in front of manifest and metadata
+            tail = self._detach_tail()
+
         # write file to zip
         if isinstance(file, (str, unicode)):
             # file is actually string
-            zipinfo = self._zip.writestr(location, file)
+            zipinfo = self._zip.writestr(location, file, align=align)
         else:
-            zipinfo = self._zip.write(file, location)
+            zipinfo = self._zip.write(file, location, align=align)
+
+        for (tail_info, data) in tail:
+            self._zip.writestr(tail_info, data)
 
         entry = ArchiveEntry(location, format=format, master=master, zipinfo=zipinfo, archive=self)
-        self.entries[entry.location] = entry
+        self._register_entry(entry)
         return entry
 
     def remove_entry(self, location):
@@ -322,13 +747,56 @@ class CombineArchive(metadata.MetaDataHolder):
         Removes an entry from the COMBINE archive. The file will remain in the
         zip archive, until pack() is called.
         """
+        self._check_writable()
+        # metadata about the entry has to be attached to it before it is gone
+        self._ensure_metadata()
         location = utils.clean_pathname(location)
         if self.entries[location]:
             self._zip.remove(location)
-            del self.entries[location]
+            if self._unregister_entry(location).description:
+                # the metadata about it is gone as well
+                self._metadata_changed = True
         else:
             raise KeyError('Did not found {loc} in COMBINE archive'.format(loc=location))
 
+    def rename_entry(self, location, new_location):
+        """
+        renames or moves an entry within the COMBINE archive. Its content is only copied,
+        if the new name does not fit into the old local file header. Metadata about the entry is kept
+
+        Returns:
+            ArchiveEntry
+        """
+        self._check_writable()
+        self._ensure_metadata()
+        location = utils.clean_pathname(location)
+        new_location = utils.clean_pathname(new_location)
+        entry = self.get_entry(location)
+
+        for loc in (location, new_location):
+            if loc in (self.MANIFEST_LOCATION, self.METADATA_LOCATION) or loc in self.ARCHIVE_REFERENCE:
+                raise exceptions.CombineArchiveException('it is not allowed to rename {loc}'.format(loc=loc))
+        if new_location in self.entries or new_location in self._zip.NameToInfo:
+            raise exceptions.CombineArchiveException('{loc} exists already in the COMBINE archive'.format(loc=new_location))
+
+        tail = []
+        if self._layout == self.LAYOUT_TAIL:
+            # a moved entry goes in front of manifest and metadata
+            tail = self._detach_tail()
+
+        entry.zipinfo = self._zip.rename(entry.zipinfo or location, new_location)
+
+        for (tail_info, data) in tail:
+            self._zip.writestr(tail_info, data)
+
+        self._unregister_entry(location)
+        entry.location = new_location
+        self._register_entry(entry)
+        if entry.description:
+            # the metadata is about the new location now
+            self._metadata_changed = True
+        return entry
+
     def get_entry(self, location):
         """
         Returns the archive entry in the given location or raises an KeyError,
@@ -340,6 +808,33 @@ class CombineArchive(metadata.MetaDataHolder):
         else:
             raise KeyError('Did not found {loc} in COMBINE archive'.format(loc=location))
 
+    def __contains__(self, location):
+        """
+        checks, if there is an entry at the given location
+        """
+        return utils.clean_pathname(location) in self.entries
+
+    def list_dir(self, path=''):
+        """
+        Returns the sorted names of all files and folders right below the folder path,
+        where folder names end with a slash. Raises a KeyError, if there is no such folder
+        """
+        return self._zip.list_dir(path.lstrip('/'))
+
+    def walk(self, path=''):
+        """
+        Generator of the tuple (folder, subfolders, files) for the folder path and all folders below it,
+        like os.walk()
+        """
+        return self._zip.walk(path.lstrip('/'))
+
+    def glob(self, pattern):
+        """
+        Returns the sorted locations matching the shell style pattern, e.g. 'model/*.xml'.
+        Wildcards do not match a slash
+        """
+        return self._zip.glob(pattern.lstrip('/'))
+
     def filter_format(self, format, regex=False):
         """
         Generator including all archive entries with a given format.
@@ -361,17 +856,66 @@ class CombineArchive(metadata.MetaDataHolder):
                     '{format} is no valid format, according to the OMEX specification. {cause}'.format(format=format,
                                                                                                        cause=e.message))
 
-        for (location, entry) in self.entries.items():
-            if pattern is not None and pattern.match(entry.format):
-                yield entry
-            elif pattern is None and format == entry.format:
+        if pattern is None:
+            formats = [format]
+        else:
+            # match each distinct format just once
+            formats = [entry_format for entry_format in self._formats
+                       if entry_format is not None and pattern.match(entry_format)]
+        for entry_format in formats:
+            for entry in list(self._formats.get(entry_format, dict()).values()):
                 yield entry
 
+    def extract_all(self, path, workers=1, format=None, regex=False):
+        """
+        extracts all entries of the COMBINE archive into the directory path.
+        If a format is given, only the entries of this format are extracted (see filter_format).
+        With workers > 1 the entries are extracted by the given number of threads
+        """
+        if format is not None:
+            entries = self.filter_format(format, regex=regex)
+        else:
+            entries = self.entries.values()
+
+        # the archive itself has no file
+        members = [entry.zipinfo for entry in entries if entry.zipinfo is not None]
+        self._zip.extractall(path, members=members, workers=workers)
+
+    def iter_contents(self, filter=None, max_chunk=None):
+        """
+        Generator of the tuple (entry, content) for all entries, for which filter(entry) returns True.
+        The entries are read in the order of their position in the archive, neighbouring small entries
+        with a single read of at most max_chunk bytes, so a scan of the whole archive is one sequential pass.
+        Manifest and metadata are not included
+        """
+        entries = dict()
+        for (location, entry) in self.entries.items():
+            if location in self.ARCHIVE_REFERENCE or location in (self.MANIFEST_LOCATION, self.METADATA_LOCATION):
+                continue
+            if filter is not None and not filter(entry):
+                continue
+            if entry.zipinfo is None:
+                entry.zipinfo = self._zip.getinfo(location)
+            entries[entry.zipinfo] = entry
+
+        for (zipinfo, data) in self._zip.iter_members(entries.keys(), max_chunk=max_chunk):
+            yield entries[zipinfo], data
+
+    def verify(self, workers=None, progress=None):
+        """
+        checks the CRC of all files in the COMBINE archive using several threads.
+        progress is called with the number of checked files and the total number of files.
+
+        Returns:
+            list of the locations of all corrupt files
+        """
+        return self._zip.verify(workers=workers, progress=progress)
+
     def get_master_entries(self):
         """
         Returns a list of entries with set master flag
         """
-        return [entry for entry in self.entries.values() if entry.master is True]
+        return list(self._masters.values())
 
 
 class ArchiveEntry(metadata.MetaDataHolder):
@@ -380,16 +924,115 @@ class ArchiveEntry(metadata.MetaDataHolder):
     """
     def __init__(self, location, format=None, master=False, zipinfo=None, archive=None):
         super(ArchiveEntry, self).__init__()
+        self.archive = archive
         self.location = location
         self.format = format
         self.master = master
-        self.archive = archive
         self.zipinfo = zipinfo
 
-    def read(self):
-        if self.zipinfo is not None and self.archive is not None:
-            return self.archive._zip.read(self.zipinfo)
-        elif self.zipinfo is None and self.archive is not None:
-            return self.archive._zip.read(self.location)
-        else:
+    def _set_indexed(self, name, value):
+        """
+        internal function.
+        sets an attribute, the archive keeps an index of, and updates the index
+        """
+        archive = self.archive
+        indexed = archive is not None and archive.entries.get(self.location) is self
+        if indexed:
+            archive._unindex_entry(self)
+        setattr(self, name, value)
+        if indexed:
+            archive._index_entry(self)
+
+    @property
+    def format(self):
+        return self._format
+
+    @format.setter
+    def format(self, value):
+        self._set_indexed('_format', value)
+
+    @property
+    def master(self):
+        return self._master
+
+    @master.setter
+    def master(self, value):
+        self._set_indexed('_master', value)
+
+    @property
+    def description(self):
+        if self.archive is not None:
+            # the metadata of the archive is read lazily
+            self.archive._ensure_metadata()
+        return self._description
+
+    @description.setter
+    def description(self, value):
+        if self.archive is not None:
+            # otherwise the metadata read later on is added to the new list
+            self.archive._ensure_metadata()
+        self._set_description(value)
+
+    def _member(self):
+        """
+        internal function.
+        returns the ZipInfo object or the location of this entry in the zip file
+        """
+        if self.archive is None:
             raise exceptions.CombineArchiveException('There is no reference back to the Combine archive')
+        if self.zipinfo is not None:
+            return self.zipinfo
+        return self.location
+
+    def read(self):
+        member = self._member()
+        return self.archive._zip.read(member)
+
+    def mmap(self):
+        """
+        returns the content of this entry as read-only buffer, which is backed by a memory map of the archive.
+        works only for uncompressed entries of archives in a file
+        """
+        member = self._member()
+        try:
+            return self.archive._zip.mmap(member)
+        except ValueError as e:
+            raise exceptions.CombineArchiveException('cannot map {loc}: {err}'.format(loc=self.location, err=e))
+
+    def open_nested(self, as_archive=False):
+        """
+        opens this entry, which is a zip file itself, as read-only ZipFile.
+        With as_archive=True it is opened as read-only CombineArchive instead, so the manifest and
+        the metadata of a nested archive can be browsed.
+        Uncompressed entries are read in place, without loading them into memory. Close it after use
+        """
+        member = self._member()
+        try:
+            if not as_archive:
+                return self.archive._zip.open_nested(member)
+            fileobj = self.archive._zip._nested_file(member)
+        except zipfile.BadZipFile as e:
+            raise exceptions.CombineArchiveException('{loc} is no zip file: {err}'.format(loc=self.location, err=e))
+
+        try:
+            nested = CombineArchive(fileobj, mode='r')
+        except zipfile.BadZipFile as e:
+            fileobj.close()
+            raise exceptions.CombineArchiveException('{loc} is no zip file: {err}'.format(loc=self.location, err=e))
+        except:
+            fileobj.close()
+            raise
+        # closed along with the nested archive
+        nested._zip._owned_fp = fileobj
+        return nested
+
+    def as_numpy(self, dtype):
+        """
+        returns the content of this entry as read-only numpy array of the given dtype, without copying it.
+        requires numpy
+        """
+        try:
+            import numpy
+        except ImportError:
+            raise exceptions.CombineArchiveException('as_numpy() requires numpy')
+        return numpy.frombuffer(self.mmap(), dtype=dtype)
@@ -15,13 +15,82 @@ import utils
 import exceptions
 
 
+class TrackedList(list):
+    """
+    list, which calls on_change after every modification
+    """
+
+    def __init__(self, iterable=(), on_change=None):
+        super(TrackedList, self).__init__(iterable)
+        self._on_change = on_change
+
+    def _changed(self):
+        if self._on_change is not None:
+            self._on_change()
+
+
+def _tracked(name):
+    """
+    wraps the list method name, so it reports the modification
+    """
+    method = getattr(list, name)
+
+    def wrapper(self, *args):
+        result = method(self, *args)
+        self._changed()
+        return result
+    wrapper.__name__ = name
+    return wrapper
+
+for _name in ('append', 'extend', 'insert', 'remove', 'pop', 'sort', 'reverse', '__setitem__', '__delitem__',
+              '__iadd__', '__imul__', '__setslice__', '__delslice__'):
+    if hasattr(list, _name):
+        setattr(TrackedList, _name, _tracked(_name))
+
+
 class MetaDataHolder(object):
     """
     Mixin for objects, which can contain/be described by meta data
     """
 
     def __init__(self):
-        self.description = []
+        # not through the property, subclasses may not be set up yet
+        self._set_description([])
+
+    @property
+    def description(self):
+        return self._description
+
+    @description.setter
+    def description(self, value):
+        self._set_description(value)
+
+    def _set_description(self, value):
+        """
+        internal function.
+        sets the list of descriptions, which tracks its changes
+        """
+        self._description = TrackedList(value, on_change=self._touch_description)
+        self._description_changed = True
+
+    def _touch_description(self):
+        self._description_changed = True
+
+    def _has_metadata_changes(self):
+        """
+        internal function.
+        checks, if a description was added, removed or modified since the last call of _mark_metadata_saved()
+        """
+        return self._description_changed or any(meta._has_changes() for meta in self._description)
+
+    def _mark_metadata_saved(self):
+        """
+        internal function.
+        marks the descriptions as unchanged, after they were read or written
+        """
+        self._description_changed = False
+        for meta in self._description:
+            meta._mark_saved()
 
     def add_description(self, meta, fragment=None):
         """
@@ -81,9 +150,35 @@ class Namespace(object):
 
 class MetaDataObject(object):
     """
-    abstract base class for all meta data utilized in COMBINE archives
+    abstract base class for all meta data utilized in COMBINE archives.
+    Setting an attribute or modifying a list attribute marks the object as changed.
+    Changes within the raw xml element are not noticed
     """
 
+    def __setattr__(self, name, value):
+        if not name.startswith('_'):
+            if isinstance(value, list) and not isinstance(value, TrackedList):
+                value = TrackedList(value, on_change=self._touch)
+            object.__setattr__(self, '_changed', True)
+        object.__setattr__(self, name, value)
+
+    def _touch(self):
+        self._changed = True
+
+    def _has_changes(self):
+        """
+        internal function.
+        checks, if the meta data was changed since the last call of _mark_saved()
+        """
+        return self.__dict__.get('_changed', False)
+
+    def _mark_saved(self):
+        """
+        internal function.
+        marks the meta data as unchanged, after it was read or written
+        """
+        self._changed = False
+
     def __init__(self, xml_element=None):
         """ XML element representing the raw meta data"""
         self._xml_element = xml_element
@@ -264,9 +359,25 @@ class OmexMetaDataObject(MetaDataObject):
         """
         return datetime.strptime(str_datetime, Namespace.dc_terms.w3cdtf_dateformat)
 
+    def _has_changes(self):
+        return super(OmexMetaDataObject, self)._has_changes() or \
+            any(vcard._changed for vcard in self.creator if isinstance(vcard, VCard))
+
+    def _mark_saved(self):
+        super(OmexMetaDataObject, self)._mark_saved()
+        for vcard in self.creator:
+            if isinstance(vcard, VCard):
+                vcard._changed = False
+
 
 class VCard(object):
 
+    def __setattr__(self, name, value):
+        # any change of a public attribute marks the VCard as changed
+        if not name.startswith('_'):
+            object.__setattr__(self, '_changed', True)
+        object.__setattr__(self, name, value)
+
     def __init__(self, family_name=None, given_name=None, email=None, organization=None):
         self.family_name    = family_name
         self.given_name     = given_name
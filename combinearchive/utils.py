@@ -9,6 +9,10 @@ __mime_pattern = re.compile(r'^([a-zA-Z0-9\+]+)/([a-zA-Z0-9\+]+)$')
 __purl_mime_base = 'http://purl.org/NET/mediatypes/{ctype}/{format}'
 __format_url_pattern = re.compile(r'^https?\:\/\/(?:www\.)?(?P<domain>[\w\.\-]+)\/(?P<format>[\w\.\-+\/]+)$')
 
+# results of check_format(), archives use just a handful of formats
+__format_cache = dict()
+__format_cache_size = 1024
+
 
 def extend_tag_name(tag_name, namespace_dict):
     """
@@ -82,6 +86,23 @@ def check_format(format, convert=True):
     Raises CombineArchiveFormatException:
         if format is unknown or not correct
     """
+    try:
+        return __format_cache[(format, convert)]
+    except KeyError:
+        pass
+
+    checked = _check_format(format, convert)
+    if len(__format_cache) >= __format_cache_size:
+        __format_cache.clear()
+    __format_cache[(format, convert)] = checked
+    return checked
+
+
+def _check_format(format, convert):
+    """
+    internal function.
+    does the work of check_format() without caching
+    """
     # first try to fix old mime type declaration, just in case
     if convert:
         format = convert_mimetype(format)
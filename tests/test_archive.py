@@ -7,11 +7,17 @@ import os
 import tempfile
 from StringIO import StringIO
 import hashlib
+import struct
 import unittest
 from test import test_support
 
 from combinearchive import combinearchive, metadata, utils, exceptions
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 class BaseReadTest(unittest.TestCase):
     """
@@ -101,6 +107,42 @@ class ReadTest(BaseReadTest):
 
         self.close_archive()
 
+    def test_extract_all(self):
+        self.open_archive()
+        directory = tempfile.mkdtemp()
+        try:
+            test_format = 'http://purl.org/NET/mediatypes/application/pdf'
+            self.carchive.extract_all(directory, workers=4, format=test_format)
+            for entry in self.carchive.filter_format(test_format):
+                with open(os.path.join(directory, entry.location), 'rb') as fp:
+                    self.assertEqual(fp.read(), entry.read())
+            self.assertFalse(os.path.exists(os.path.join(directory, self.carchive.MANIFEST_LOCATION)))
+
+            # everything else
+            self.carchive.extract_all(directory, workers=4)
+            self.assertTrue(os.path.exists(os.path.join(directory, self.carchive.MANIFEST_LOCATION)))
+        finally:
+            shutil.rmtree(directory)
+        self.close_archive()
+
+    def test_verify(self):
+        self.open_archive()
+        calls = list()
+        self.assertEqual(self.carchive.verify(workers=2, progress=lambda *args: calls.append(args)), [])
+        self.assertEqual(calls[-1][0], calls[-1][1])
+        self.close_archive()
+
+    def test_verify_policy(self):
+        errors = list()
+        self.carchive = combinearchive.CombineArchive(self.archive_location,
+                                                      verify_crc=combinearchive.CombineArchive.VERIFY_DEFERRED,
+                                                      on_crc_error=errors.append)
+        for entry in self.carchive.entries.values():
+            if entry.location != '.':
+                entry.read()
+        self.close_archive()
+        self.assertEqual(errors, [])
+
     def test_read_file(self):
         self.open_archive()
 
@@ -186,6 +228,687 @@ class AddReadTest(BaseReadTest):
         self.close_archive()
 
 
+class ReuseSpaceTest(BaseReadTest):
+    TEST_ARCHIVE = 'tests/data/all-singing-all-dancing.omex'
+
+    def open_archive(self):
+        self.carchive = combinearchive.CombineArchive(self.archive_location, reuse_space=True)
+        return self.carchive
+
+    def test_replace_keeps_size(self):
+        self.open_archive()
+        self.carchive.add_entry(self.get_random_content(), "text/plain", "a/test.txt")
+        self.carchive.add_entry(self.get_random_content(), "text/plain", "b/test.txt")
+        self.carchive.pack()
+        # the first replace also rewrites the metadata, which drops the descriptions of the entry
+        self.carchive.add_entry(self.get_random_content(), "text/plain", "a/test.txt", replace=True)
+        self.carchive.pack()
+        size = os.path.getsize(self.archive_location)
+
+        # replacing entries and rewriting the manifest reuses the left holes
+        for x in range(5):
+            self.carchive.add_entry(self.get_random_content(), "text/plain", "a/test.txt", replace=True)
+            self.carchive.pack()
+        self.assertEqual(os.path.getsize(self.archive_location), size)
+
+        self.carchive.close()
+        self.open_archive()
+        self.assertEqual(self.carchive.get_entry("a/test.txt").read(), self.get_random_content())
+        self.assertIsNone(self.carchive._zip.testzip())
+        self.close_archive()
+
+
+class ReserveTest(BaseReadTest):
+    TEST_ARCHIVE = 'tests/data/all-singing-all-dancing.omex'
+
+    def test_pack_in_place(self):
+        self.open_archive()
+        # pack() only rewrites what changed, so touch the manifest and the metadata first
+        self.carchive.add_entry(self.get_random_content(), "text/plain", "a/test.txt")
+        self.carchive.add_description(metadata.OmexMetaDataObject(description="a first change"))
+        self.carchive.pack()
+        manifest = self.carchive._zip.getinfo(self.carchive.MANIFEST_LOCATION)
+        offset = manifest.header_offset
+        size = os.path.getsize(self.archive_location)
+
+        # small metadata changes fit into the reserved space
+        meta = metadata.OmexMetaDataObject(description="a small change")
+        self.carchive.add_description(meta)
+        self.carchive.pack()
+
+        manifest = self.carchive._zip.getinfo(self.carchive.MANIFEST_LOCATION)
+        self.assertEqual(manifest.header_offset, offset)
+        self.assertEqual(os.path.getsize(self.archive_location), size)
+
+        self.carchive.close()
+        self.open_archive()
+        self.assertIn("a small change", [desc.description for desc in self.carchive.description])
+        self.close_archive()
+
+
+class TailLayoutTest(BaseReadTest):
+    TEST_ARCHIVE = 'tests/data/all-singing-all-dancing.omex'
+
+    def open_archive(self):
+        self.carchive = combinearchive.CombineArchive(self.archive_location,
+                                                      layout=combinearchive.CombineArchive.LAYOUT_TAIL)
+        return self.carchive
+
+    def assert_tail(self):
+        infos = sorted(self.carchive._zip.infolist(), key=lambda zipinfo: zipinfo.header_offset)
+        self.assertEqual(set(zipinfo.filename for zipinfo in infos[-2:]),
+                         set([self.carchive.MANIFEST_LOCATION, self.carchive.METADATA_LOCATION]))
+
+    def test_repack_pack(self):
+        self.open_archive()
+        self.carchive.repack()
+        self.assert_tail()
+        offsets = dict((zipinfo.filename, zipinfo.header_offset) for zipinfo in self.carchive._zip.infolist())
+
+        # new entries are written in front of manifest and metadata
+        self.carchive.add_entry(self.get_random_content(), "text/plain", "a/test.txt")
+        meta = metadata.OmexMetaDataObject(description="a change")
+        self.carchive.add_description(meta)
+        self.carchive.pack()
+        self.assert_tail()
+
+        # no other entry was moved
+        for zipinfo in self.carchive._zip.infolist():
+            if zipinfo.filename not in (self.carchive.MANIFEST_LOCATION, self.carchive.METADATA_LOCATION,
+                                        "a/test.txt"):
+                self.assertEqual(zipinfo.header_offset, offsets[zipinfo.filename])
+
+        self.carchive.close()
+        self.open_archive()
+        self.assertEqual(self.carchive.get_entry("a/test.txt").read(), self.get_random_content())
+        self.assertIn("a change", [desc.description for desc in self.carchive.description])
+        self.assertIsNone(self.carchive._zip.testzip())
+        self.close_archive()
+
+    def test_metadata_not_in_manifest(self):
+        self.open_archive()
+        self.carchive.repack()
+        descriptions = len(self.carchive.description)
+        # the metadata file is left out of the manifest
+        self.carchive._unregister_entry(self.carchive.METADATA_LOCATION)
+        self.carchive.pack()
+        self.assert_tail()
+        self.close_archive()
+
+        self.open_archive()
+        self.assertIn(self.carchive.METADATA_LOCATION, self.carchive.entries)
+        self.assertEqual(len(self.carchive.description), descriptions)
+        self.assertIsNone(self.carchive._zip.testzip())
+        self.close_archive()
+
+    def test_invalid_layout(self):
+        with self.assertRaises(exceptions.CombineArchiveException):
+            combinearchive.CombineArchive(self.archive_location, layout='foobar')
+
+        with self.assertRaises(exceptions.CombineArchiveException):
+            combinearchive.CombineArchive(self.archive_location, reuse_space=True,
+                                          layout=combinearchive.CombineArchive.LAYOUT_TAIL)
+
+
+class DurabilityTest(BaseReadTest):
+    TEST_ARCHIVE = 'tests/data/all-singing-all-dancing.omex'
+
+    def open_archive(self):
+        self.carchive = combinearchive.CombineArchive(self.archive_location,
+                                                      durability=combinearchive.CombineArchive.DURABILITY_JOURNAL)
+        return self.carchive
+
+    def test_pack_repack(self):
+        self.open_archive()
+        self.carchive.add_entry(self.get_random_content(), "text/plain", "a/test.txt")
+        self.carchive.pack()
+        self.assertFalse(os.path.exists(self.archive_location + '.journal'))
+        self.assertEqual(self.carchive.get_entry("a/test.txt").read(), self.get_random_content())
+
+        self.carchive.add_entry(self.get_random_content(), "text/plain", "b/test.txt")
+        self.carchive.repack()
+        self.carchive.close()
+
+        self.open_archive()
+        self.assertEqual(self.carchive.get_entry("b/test.txt").read(), self.get_random_content())
+        self.assertIsNone(self.carchive._zip.testzip())
+        self.close_archive()
+        self.assertFalse(os.path.exists(self.archive_location + '.journal'))
+
+
+class RenameTest(BaseReadTest):
+    TEST_ARCHIVE = 'tests/data/all-singing-all-dancing.omex'
+
+    def test_rename(self):
+        self.open_archive()
+        entry = self.carchive.add_entry(self.get_random_content(), "text/plain", "a/test.txt")
+        entry.add_description(metadata.OmexMetaDataObject(description="renamed entry"))
+        self.carchive.pack()
+
+        content = self.carchive.get_entry('/model/BIOMD0000000144.xml').read()
+        self.carchive.rename_entry('/model/BIOMD0000000144.xml', 'models/BIOMD0000000144.xml')
+        self.carchive.rename_entry('a/test.txt', 'b/test.txt')
+        self.assertEqual(self.carchive.get_entry('b/test.txt').read(), self.get_random_content())
+        self.carchive.pack()
+        self.close_archive()
+
+        self.open_archive()
+        self.assertNotIn('model/BIOMD0000000144.xml', self.carchive.entries)
+        self.assertEqual(self.carchive.get_entry('models/BIOMD0000000144.xml').read(), content)
+        entry = self.carchive.get_entry('b/test.txt')
+        self.assertEqual(entry.read(), self.get_random_content())
+        self.assertEqual([desc.description for desc in entry.description], ["renamed entry"])
+        self.assertIsNone(self.carchive._zip.testzip())
+        self.close_archive()
+
+    def test_tail_layout(self):
+        self.carchive = combinearchive.CombineArchive(self.archive_location,
+                                                      layout=combinearchive.CombineArchive.LAYOUT_TAIL)
+        self.carchive.repack()
+        self.carchive.rename_entry('/model/BIOMD0000000144.xml', 'a/much/longer/path/to/the/model.xml')
+        infos = sorted(self.carchive._zip.infolist(), key=lambda zipinfo: zipinfo.header_offset)
+        self.assertEqual(set(zipinfo.filename for zipinfo in infos[-2:]),
+                         set([self.carchive.MANIFEST_LOCATION, self.carchive.METADATA_LOCATION]))
+        self.close_archive()
+
+    def test_invalid(self):
+        self.open_archive()
+        with self.assertRaises(KeyError):
+            self.carchive.rename_entry('missing.txt', 'other.txt')
+        with self.assertRaises(exceptions.CombineArchiveException):
+            self.carchive.rename_entry('/model/BIOMD0000000144.xml', self.carchive.MANIFEST_LOCATION)
+        with self.assertRaises(exceptions.CombineArchiveException):
+            self.carchive.rename_entry(self.carchive.METADATA_LOCATION, 'other.rdf')
+        with self.assertRaises(exceptions.CombineArchiveException):
+            self.carchive.rename_entry('/model/BIOMD0000000144.xml', self.carchive.METADATA_LOCATION)
+        self.close_archive()
+
+
+class NestedArchiveTest(BaseReadTest):
+    TEST_ARCHIVE = 'tests/data/all-singing-all-dancing.omex'
+
+    def test_open_nested(self):
+        with open(self.TEST_ARCHIVE, 'rb') as fp:
+            inner = fp.read()
+        self.open_archive()
+        self.carchive.add_entry(inner, 'application/zip', 'nested/inner.omex')
+        self.carchive.pack()
+        self.close_archive()
+
+        self.open_archive()
+        nested = self.carchive.get_entry('nested/inner.omex').open_nested()
+        self.assertIn('manifest.xml', nested.namelist())
+        self.assertIsNone(nested.testzip())
+        nested.close()
+        with self.assertRaises(exceptions.CombineArchiveException):
+            self.carchive.get_entry(self.carchive.MANIFEST_LOCATION).open_nested()
+        self.close_archive()
+
+    def test_open_nested_archive(self):
+        with open(self.TEST_ARCHIVE, 'rb') as fp:
+            inner = fp.read()
+        self.open_archive()
+        self.carchive.add_entry(inner, 'application/zip', 'nested/inner.omex')
+        self.carchive.pack()
+        self.close_archive()
+
+        self.open_archive()
+        expected = combinearchive.CombineArchive(self.TEST_ARCHIVE, mode='r')
+        nested = self.carchive.get_entry('nested/inner.omex').open_nested(as_archive=True)
+        self.assertEqual(sorted(nested.entries), sorted(expected.entries))
+        self.assertEqual(len(nested.description), len(expected.description))
+        self.assertEqual(nested.get_entry('/model/BIOMD0000000144.xml').read(),
+                         expected.get_entry('/model/BIOMD0000000144.xml').read())
+        with self.assertRaises(exceptions.CombineArchiveException):
+            nested.add_entry('content', 'text/plain', 'new.txt')
+        fileobj = nested._zip._owned_fp
+        nested.close()
+        expected.close()
+        self.assertTrue(fileobj.closed)
+        with self.assertRaises(exceptions.CombineArchiveException):
+            self.carchive.get_entry(self.carchive.MANIFEST_LOCATION).open_nested(as_archive=True)
+        self.close_archive()
+
+
+class FlushPolicyTest(BaseReadTest):
+    TEST_ARCHIVE = 'tests/data/all-singing-all-dancing.omex'
+
+    def test_bulk_import(self):
+        self.carchive = combinearchive.CombineArchive(self.archive_location,
+                                                      flush_policy=combinearchive.CombineArchive.FLUSH_COMMIT,
+                                                      buffer_size=1 << 20)
+        for i in range(200):
+            self.carchive.add_entry('content {}'.format(i), 'text/plain', 'bulk/{}.txt'.format(i))
+        self.assertEqual(self.carchive.get_entry('bulk/7.txt').read(), 'content 7')
+        self.carchive.pack()
+        self.close_archive()
+
+        self.open_archive()
+        self.assertEqual(self.carchive.get_entry('bulk/199.txt').read(), 'content 199')
+        self.assertIsNone(self.carchive._zip.testzip())
+        self.close_archive()
+
+
+class AlignmentTest(BaseReadTest):
+    TEST_ARCHIVE = 'tests/data/all-singing-all-dancing.omex'
+
+    def test_mmap(self):
+        self.open_archive()
+        data = struct.pack('<512d', *range(512))
+        self.carchive.add_entry(data, 'text/plain', 'results/data.bin', align=4096)
+        self.carchive.pack()
+        self.close_archive()
+
+        self.open_archive()
+        entry = self.carchive.get_entry('results/data.bin')
+        self.assertEqual(self.carchive._zip._resolve_data_offset(entry.zipinfo) % 4096, 0)
+        self.assertEqual(bytes(entry.mmap()), data)
+        with self.assertRaises(exceptions.CombineArchiveException):
+            self.carchive.get_entry('/model/BIOMD0000000144.xml').mmap()
+
+        # repack keeps the alignment
+        self.carchive.repack()
+        entry = self.carchive.get_entry('results/data.bin')
+        self.assertEqual(self.carchive._zip._resolve_data_offset(entry.zipinfo) % 4096, 0)
+        self.assertEqual(bytes(entry.mmap()), data)
+        self.close_archive()
+
+    @unittest.skipIf(numpy is None, 'requires numpy')
+    def test_as_numpy(self):
+        self.open_archive()
+        self.carchive.add_entry(numpy.arange(1000, dtype='<f8').tostring(), 'text/plain', 'results/data.bin',
+                                align=4096)
+        array = self.carchive.get_entry('results/data.bin').as_numpy('<f8')
+        self.assertEqual(array.shape, (1000,))
+        self.assertEqual(array[999], 999.0)
+        self.close_archive()
+
+
+class IOHintsTest(BaseReadTest):
+    TEST_ARCHIVE = 'tests/data/all-singing-all-dancing.omex'
+
+    def test_verify_repack(self):
+        self.carchive = combinearchive.CombineArchive(self.archive_location, io_hints=True, drop_cache=True)
+        self.assertTrue(self.carchive._zip._io_hints)
+        self.assertTrue(self.carchive._zip._drop_cache)
+        self.assertEqual(self.carchive.verify(), [])
+        self.carchive.repack()
+        # the reopened zip file keeps the hints
+        self.assertTrue(self.carchive._zip._io_hints)
+        self.assertTrue(self.carchive._zip._drop_cache)
+        self.assertEqual(self.carchive.verify(), [])
+        self.close_archive()
+
+
+class RepackCompressionTest(BaseReadTest):
+    TEST_ARCHIVE = 'tests/data/all-singing-all-dancing.omex'
+
+    def test_compression(self):
+        self.open_archive()
+        contents = dict((entry.location, data) for (entry, data) in self.carchive.iter_contents())
+        progress = []
+        self.carchive.repack(compression=combinearchive.CombineArchive.ZIP_DEFLATED, workers=2,
+                             progress=lambda done, total: progress.append((done, total)))
+        self.assertEqual(progress[-1], (len(contents), len(contents)))
+        self.close_archive()
+
+        self.open_archive()
+        self.assertEqual(dict((entry.location, data) for (entry, data) in self.carchive.iter_contents()), contents)
+        for location in contents:
+            self.assertEqual(self.carchive.get_entry(location).zipinfo.compress_type,
+                             combinearchive.CombineArchive.ZIP_DEFLATED)
+
+        # the compression is kept by default
+        self.carchive.repack()
+        self.assertEqual(set(self.carchive.get_entry(location).zipinfo.compress_type for location in contents),
+                         set([combinearchive.CombineArchive.ZIP_DEFLATED]))
+        self.assertEqual(self.carchive.verify(), [])
+        self.close_archive()
+
+
+class IterContentsTest(BaseReadTest):
+    TEST_ARCHIVE = 'tests/data/all-singing-all-dancing.omex'
+
+    def test_iter_contents(self):
+        self.open_archive()
+        contents = dict((entry.location, data) for (entry, data) in self.carchive.iter_contents())
+        self.assertNotIn(combinearchive.CombineArchive.MANIFEST_LOCATION, contents)
+        for location in contents:
+            self.assertEqual(contents[location], self.carchive.get_entry(location).read())
+
+        # only the filtered entries in the order of their offsets
+        sbml = 'http://identifiers.org/combine.specifications/sbml'
+        result = list(self.carchive.iter_contents(filter=lambda entry: entry.format.startswith(sbml),
+                                                  max_chunk=1024))
+        self.assertTrue(result)
+        self.assertEqual(set(entry for (entry, data) in result), set(self.carchive.filter_format(sbml + '.*', regex=True)))
+        offsets = [entry.zipinfo.header_offset for (entry, data) in result]
+        self.assertEqual(offsets, sorted(offsets))
+        self.close_archive()
+
+
+class BrowseTest(BaseReadTest):
+    TEST_ARCHIVE = 'tests/data/all-singing-all-dancing.omex'
+
+    def test_browse(self):
+        self.open_archive()
+        self.carchive.add_entry('content', 'text/plain', 'results/run1/values.csv')
+        self.carchive.add_entry('content', 'text/plain', 'results/run2/values.csv')
+        self.assertIn('/results/run1/values.csv', self.carchive)
+        self.assertNotIn('results/run3/values.csv', self.carchive)
+
+        self.assertIn('results/', self.carchive.list_dir())
+        self.assertEqual(self.carchive.list_dir('/results'), ['run1/', 'run2/'])
+        self.assertEqual(self.carchive.glob('results/*/values.csv'),
+                         ['results/run1/values.csv', 'results/run2/values.csv'])
+        folders = [folder for (folder, subfolders, files) in self.carchive.walk('results')]
+        self.assertEqual(folders, ['results/', 'results/run1/', 'results/run2/'])
+
+        self.carchive.remove_entry('results/run2/values.csv')
+        self.assertEqual(self.carchive.list_dir('results'), ['run1/'])
+        self.close_archive()
+
+
+class ReadOnlyTest(BaseReadTest):
+    TEST_ARCHIVE = 'tests/data/all-singing-all-dancing.omex'
+
+    def open_archive(self):
+        self.carchive = combinearchive.CombineArchive(self.archive_location, mode='r')
+        return self.carchive
+
+    def contents(self):
+        return dict((location, entry.read()) for (location, entry) in self.carchive.entries.items()
+                    if location not in combinearchive.CombineArchive.ARCHIVE_REFERENCE)
+
+    def test_read(self):
+        self.open_archive()
+        self.assertEqual(self.carchive._zip.fp.mode, 'rb')
+        self.assertTrue(self.carchive.description)
+        self.assertEqual(self.carchive.verify(), [])
+        self.assertTrue(self.contents())
+
+    def test_modify(self):
+        self.open_archive()
+        location = 'model/BIOMD0000000144.xml'
+        with self.assertRaises(exceptions.CombineArchiveException):
+            self.carchive.add_entry('content', 'text/plain', 'new.txt')
+        with self.assertRaises(exceptions.CombineArchiveException):
+            self.carchive.remove_entry(location)
+        with self.assertRaises(exceptions.CombineArchiveException):
+            self.carchive.rename_entry(location, 'renamed.xml')
+        with self.assertRaises(exceptions.CombineArchiveException):
+            self.carchive.pack()
+        with self.assertRaises(exceptions.CombineArchiveException):
+            self.carchive.repack()
+        self.assertIn(location, self.carchive)
+
+    def test_bad_mode(self):
+        with self.assertRaises(exceptions.CombineArchiveException):
+            combinearchive.CombineArchive(self.archive_location, mode='w')
+
+    def test_threads(self):
+        from multiprocessing.pool import ThreadPool
+        self.open_archive()
+        expected = self.contents()
+        entries = list(self.carchive.entries.values()) * 10
+        pool = ThreadPool(4)
+        try:
+            results = pool.map(lambda entry: (entry.location, entry.read()),
+                               [entry for entry in entries if entry.zipinfo is not None])
+        finally:
+            pool.terminate()
+            pool.join()
+        for (location, data) in results:
+            self.assertEqual(data, expected[location])
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires os.fork()')
+    def test_fork(self):
+        self.open_archive()
+        expected = self.contents()
+        pid = os.fork()
+        if pid == 0:
+            # the child shares the open file with the parent
+            ok = False
+            try:
+                ok = all(self.contents() == expected for x in range(20))
+            finally:
+                os._exit(0 if ok else 1)
+        for x in range(20):
+            self.assertEqual(self.contents(), expected)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+
+
+class LazyMetadataTest(BaseReadTest):
+    TEST_ARCHIVE = 'tests/data/all-singing-all-dancing.omex'
+
+    def test_lazy(self):
+        self.open_archive()
+        self.carchive.get_entry('/model/BIOMD0000000144.xml').read()
+        self.assertFalse(self.carchive._metadata_loaded)
+        self.assertTrue(self.carchive.description)
+        self.assertTrue(self.carchive._metadata_loaded)
+        self.close_archive()
+
+    def test_entry_first(self):
+        self.open_archive()
+        described = [location for (location, entry) in self.carchive.entries.items() if entry.description]
+        self.assertTrue(described)
+        self.close_archive()
+
+        # removing an entry reads the metadata about it beforehand
+        self.open_archive()
+        self.carchive.remove_entry(described[0])
+        self.carchive.pack()
+        self.close_archive()
+        self.open_archive()
+        self.assertTrue(self.carchive.description)
+        self.close_archive()
+
+    def test_assign(self):
+        # an assigned list replaces the descriptions, which are not read yet
+        self.open_archive()
+        location = [location for (location, entry) in self.carchive.entries.items() if entry.description][0]
+        self.close_archive()
+
+        self.open_archive()
+        self.carchive.description = []
+        self.carchive.add_description(metadata.OmexMetaDataObject(description='HELLO-NEW'))
+        self.carchive.get_entry(location).description = []
+        self.assertEqual([desc.description for desc in self.carchive.description], ['HELLO-NEW'])
+        self.carchive.pack()
+        self.close_archive()
+
+        self.open_archive()
+        self.assertEqual([desc.description for desc in self.carchive.description], ['HELLO-NEW'])
+        self.assertEqual(self.carchive.get_entry(location).description, [])
+        self.close_archive()
+
+    def test_threads(self):
+        from multiprocessing.pool import ThreadPool
+        self.open_archive()
+        read_metadata = self.carchive._read_metadata
+        calls = []
+
+        def counting():
+            calls.append(1)
+            read_metadata()
+        self.carchive._read_metadata = counting
+
+        pool = ThreadPool(4)
+        try:
+            counts = pool.map(lambda entry: len(entry.description), list(self.carchive.entries.values()) * 10)
+        finally:
+            pool.terminate()
+            pool.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(counts, [len(entry.description) for entry in self.carchive.entries.values()] * 10)
+        self.close_archive()
+
+
+class DirtyTrackingTest(BaseReadTest):
+    TEST_ARCHIVE = 'tests/data/all-singing-all-dancing.omex'
+
+    def test_untouched(self):
+        self.open_archive()
+        for entry in self.carchive.entries.values():
+            entry.description
+        self.assertFalse(self.carchive.has_changes())
+        stat = os.stat(self.archive_location)
+        self.carchive.pack()
+        self.assertEqual(os.stat(self.archive_location).st_mtime, stat.st_mtime)
+        self.assertEqual(os.path.getsize(self.archive_location), stat.st_size)
+        self.close_archive()
+
+    def test_manifest(self):
+        self.open_archive()
+        self.carchive.add_entry(self.get_random_content(), "text/plain", "a/test.txt")
+        self.assertTrue(self.carchive._manifest_changed)
+        self.assertFalse(self.carchive._metadata_has_changes())
+        self.carchive.pack()
+        self.assertFalse(self.carchive.has_changes())
+
+        self.carchive.get_entry("a/test.txt").format = 'text/html'
+        self.assertTrue(self.carchive.has_changes())
+        self.close_archive()
+
+    def test_metadata(self):
+        self.open_archive()
+        descriptions = [desc for desc in self.carchive.description
+                        if isinstance(desc, metadata.OmexMetaDataObject) and desc.creator]
+        self.assertTrue(descriptions)
+        self.assertFalse(self.carchive.has_changes())
+
+        # changes deep inside the metadata are noticed as well
+        descriptions[0].creator[0].email = 'someone@example.org'
+        self.assertTrue(self.carchive.has_changes())
+        self.carchive.pack()
+        self.assertFalse(self.carchive.has_changes())
+
+        descriptions = [desc for desc in self.carchive.description if isinstance(desc, metadata.OmexMetaDataObject)]
+        descriptions[0].creator.append(metadata.VCard(family_name='Doe'))
+        self.assertTrue(self.carchive.has_changes())
+        self.carchive.pack()
+        self.close_archive()
+
+        self.open_archive()
+        self.assertIn('someone@example.org', [vcard.email for desc in self.carchive.description
+                                              if isinstance(desc, metadata.OmexMetaDataObject)
+                                              for vcard in desc.creator])
+        self.close_archive()
+
+    def test_assign_unloaded(self):
+        # assigning before the metadata was read is a change as well
+        self.open_archive()
+        self.assertFalse(self.carchive._metadata_loaded)
+        self.carchive.description = []
+        self.assertTrue(self.carchive.has_changes())
+        self.carchive.pack()
+        self.assertFalse(self.carchive.has_changes())
+        self.close_archive()
+
+        self.open_archive()
+        self.assertEqual(self.carchive.description, [])
+        self.close_archive()
+
+
+class LargeManifestTest(BaseReadTest):
+    TEST_ARCHIVE = 'tests/data/all-singing-all-dancing.omex'
+
+    def test_many_entries(self):
+        self.carchive = combinearchive.CombineArchive(self.archive_location, flush_policy=combinearchive.CombineArchive.FLUSH_COMMIT)
+        count = len(self.carchive.entries)
+        for i in range(2000):
+            self.carchive.add_entry('content {}'.format(i), 'text/plain', 'many/{}.txt'.format(i), master=(i == 7))
+        self.carchive.pack()
+        self.close_archive()
+
+        self.open_archive()
+        self.assertEqual(len(self.carchive.entries), count + 2000)
+        entry = self.carchive.get_entry('many/1999.txt')
+        self.assertEqual(entry.format, 'http://purl.org/NET/mediatypes/text/plain')
+        self.assertEqual(entry.read(), 'content 1999')
+        self.close_archive()
+
+
+class IndexTest(BaseReadTest):
+    TEST_ARCHIVE = 'tests/data/paper-repressilator.omex'
+
+    def test_master(self):
+        self.open_archive()
+        masters = self.carchive.get_master_entries()
+        self.assertEqual(len(masters), 1)
+        entry = masters[0]
+        entry.master = False
+        self.assertEqual(self.carchive.get_master_entries(), [])
+        entry.master = True
+        self.assertEqual(self.carchive.get_master_entries(), [entry])
+
+        new = self.carchive.add_entry('content', 'text/plain', 'new.txt', master=True)
+        self.assertEqual(len(self.carchive.get_master_entries()), 2)
+        self.carchive.remove_entry('new.txt')
+        self.assertEqual(self.carchive.get_master_entries(), [entry])
+        self.assertFalse(new in self.carchive.get_master_entries())
+
+        # only True sets the master flag
+        entry.master = 'yes'
+        self.assertEqual(self.carchive.get_master_entries(), [])
+        entry.master = True
+        self.assertEqual(self.carchive.get_master_entries(), [entry])
+        self.close_archive()
+
+    def test_master_reopen(self):
+        # the master flag is written namespaced and read back
+        self.open_archive()
+        old = self.carchive.get_master_entries()[0].location
+        self.carchive.add_entry('content', 'text/plain', 'new.txt', master=True)
+        self.carchive.pack()
+        self.close_archive()
+
+        self.open_archive()
+        self.assertTrue(self.carchive.get_entry('new.txt').master)
+        self.assertEqual(set(entry.location for entry in self.carchive.get_master_entries()),
+                         set([old, 'new.txt']))
+        self.close_archive()
+
+    def test_formats(self):
+        self.open_archive()
+        plain = 'http://purl.org/NET/mediatypes/text/plain'
+        csv = 'http://purl.org/NET/mediatypes/text/csv'
+        first = self.carchive.add_entry('content', 'text/plain', 'first.txt')
+        second = self.carchive.add_entry('content', 'text/plain', 'second.txt')
+        self.assertEqual(set(self.carchive.filter_format(plain)), set([first, second]))
+
+        # renamed, removed and changed entries
+        self.carchive.rename_entry('first.txt', 'renamed.txt')
+        self.assertEqual(set(entry.location for entry in self.carchive.filter_format(plain)),
+                         set(['renamed.txt', 'second.txt']))
+        second.format = csv
+        self.assertEqual(list(self.carchive.filter_format(plain)), [first])
+        self.assertEqual(list(self.carchive.filter_format(csv)), [second])
+        self.assertEqual(set(self.carchive.filter_format('.*/text/.*', regex=True)), set([first, second]))
+        self.carchive.remove_entry('renamed.txt')
+        self.assertEqual(list(self.carchive.filter_format(plain)), [])
+        self.assertNotIn(plain, self.carchive._formats)
+
+        with self.assertRaises(KeyError):
+            list(self.carchive.filter_format('foobar'))
+        self.close_archive()
+
+    def test_reopen(self):
+        self.open_archive()
+        formats = dict((entry_format, set(entries)) for (entry_format, entries) in self.carchive._formats.items())
+        self.carchive.add_entry('content', 'text/plain', 'first.txt', master=True)
+        self.carchive.pack()
+        self.close_archive()
+
+        self.open_archive()
+        self.assertEqual(len(self.carchive.get_master_entries()), 2)
+        self.assertEqual(len(list(self.carchive.filter_format('http://purl.org/NET/mediatypes/text/plain'))), 1)
+        for (entry_format, locations) in formats.items():
+            self.assertEqual(set(entry.location for entry in self.carchive.filter_format(entry_format)), locations)
+        self.close_archive()
+
+
 class BadArchiveTest(unittest.TestCase):
 
     def test_broken_manifest(self):
@@ -207,11 +930,15 @@ class BadArchiveTest(unittest.TestCase):
 
     def test_modified_meta(self):
 
-        with self.assertRaises(exceptions.CombineArchiveException):
-            combinearchive.CombineArchive('tests/data/paper-repressilator-mod-meta.omex')
-
-        with self.assertRaises(exceptions.CombineArchiveException):
-            combinearchive.CombineArchive('tests/data/paper-repressilator-mod-meta-2.omex')
+        # the metadata is only read on the first access
+        for name in ('tests/data/paper-repressilator-mod-meta.omex', 'tests/data/paper-repressilator-mod-meta-2.omex'):
+            archive = combinearchive.CombineArchive(name)
+            with self.assertRaises(exceptions.CombineArchiveException):
+                archive.description
+            # and raises again on the next one
+            with self.assertRaises(exceptions.CombineArchiveException):
+                list(archive.entries.values())[0].description
+            archive.close()
 
 
 class InMemoryReadTest(InMemoryBaseTest):
@@ -285,6 +1012,96 @@ class InMemoryAddReadTest(InMemoryBaseTest):
         self.close_archive()
 
 
+class InMemoryBackendTest(InMemoryBaseTest):
+    TEST_ARCHIVE = 'tests/data/all-singing-all-dancing.omex'
+
+    def setUp(self):
+        super(InMemoryBackendTest, self).setUp()
+        self._buffer = StringIO()
+
+    def test_new(self):
+        self.carchive = combinearchive.CombineArchive(None)
+        self.carchive.add_entry(self.get_random_content(), "text/plain", "a/test.txt", master=True)
+        self.carchive.add_description(metadata.OmexMetaDataObject(description="in memory"))
+        data = self.carchive.getvalue()
+        self.assertFalse(self.carchive.has_changes())
+        self.close_archive()
+
+        self.carchive = combinearchive.CombineArchive(StringIO(data), mode='r')
+        self.assertEqual(self.carchive.get_entry("a/test.txt").read(), self.get_random_content())
+        self.assertEqual(self.carchive.get_master_entries()[0].location, "a/test.txt")
+        self.assertEqual([desc.description for desc in self.carchive.description], ["in memory"])
+        self.assertEqual(self.carchive.getvalue(), data)
+        self.close_archive()
+
+    def test_not_in_memory(self):
+        self.carchive = combinearchive.CombineArchive(self.archive_location)
+        with self.assertRaises(exceptions.CombineArchiveException):
+            self.carchive.getvalue()
+        self.close_archive()
+
+    def test_repack(self):
+        self.open_archive()
+        size = len(self._buffer.getvalue())
+        self.carchive.remove_entry('model/calzone_2007.ai')
+        self.carchive.repack()
+        # the buffer is rewritten, not replaced
+        self.assertIs(self.carchive._archive, self._buffer)
+        self.assertLess(len(self._buffer.getvalue()), size)
+        self.reopen_archive()
+        self.assertNotIn('model/calzone_2007.ai', self.carchive)
+        self.assertEqual(self.carchive.verify(), [])
+        self.close_archive()
+
+    def test_export(self):
+        self.open_archive()
+        self.carchive.add_entry(self.get_random_content(), "text/plain", "a/test.txt")
+        name = self.get_random_filename()
+        with open(name, 'wb') as fp:
+            # a file, which cannot be read, just gets a copy
+            self.carchive.repack(output_file=fp)
+        self.assertIs(self.carchive._archive, self._buffer)
+        self.assertFalse(self.carchive.has_changes())
+        self.assertEqual(self.carchive.get_entry("a/test.txt").read(), self.get_random_content())
+        self.carchive.close()
+
+        for archive in (name, self._buffer):
+            self.carchive = combinearchive.CombineArchive(archive)
+            self.assertEqual(self.carchive.get_entry("a/test.txt").read(), self.get_random_content())
+            self.assertEqual(self.carchive.verify(), [])
+            self.carchive.close()
+
+    def test_export_stream(self):
+        class WriteOnly(object):
+            # like a response body or a pipe, which can neither be read, seeked nor truncated
+            def __init__(self):
+                self.data = []
+                self.position = 0
+
+            def write(self, data):
+                self.data.append(data)
+                self.position += len(data)
+
+            def tell(self):
+                return self.position
+
+            def flush(self):
+                pass
+
+        self.open_archive()
+        self.carchive.add_entry(self.get_random_content(), "text/plain", "a/test.txt")
+        stream = WriteOnly()
+        self.carchive.repack(output_file=stream)
+        self.assertIs(self.carchive._archive, self._buffer)
+        self.assertFalse(self.carchive.has_changes())
+        self.carchive.close()
+
+        self.carchive = combinearchive.CombineArchive(StringIO(''.join(stream.data)), mode='r')
+        self.assertEqual(self.carchive.get_entry("a/test.txt").read(), self.get_random_content())
+        self.assertEqual(self.carchive.verify(), [])
+        self.carchive.close()
+
+
 class FormatConversionTest(unittest.TestCase):
 
     def test_formatcheck(self):
@@ -315,6 +1132,15 @@ class FormatConversionTest(unittest.TestCase):
         self.assertEqual(utils.check_format('application/pdf', convert=True),
                          'http://purl.org/NET/mediatypes/application/pdf')
 
+    def test_cached(self):
+        for x in range(2):
+            self.assertEqual(utils.check_format('text/plain', convert=True),
+                             'http://purl.org/NET/mediatypes/text/plain')
+            self.assertEqual(utils.check_format('text/plain', convert=False), 'text/plain')
+            # errors are raised each time
+            with self.assertRaises(exceptions.CombineArchiveFormatException):
+                utils.check_format('foobar', convert=False)
+
 
 def do_tests():
     """
@@ -323,8 +1149,26 @@ def do_tests():
     test_support.run_unittest(ReadTest,
                               AddDeleteTest,
                               AddReadTest,
+                              ReuseSpaceTest,
+                              ReserveTest,
+                              TailLayoutTest,
+                              DurabilityTest,
+                              RenameTest,
+                              NestedArchiveTest,
+                              FlushPolicyTest,
+                              AlignmentTest,
+                              IOHintsTest,
+                              RepackCompressionTest,
+                              IterContentsTest,
+                              BrowseTest,
+                              ReadOnlyTest,
+                              LazyMetadataTest,
+                              DirtyTrackingTest,
+                              LargeManifestTest,
+                              IndexTest,
                               BadArchiveTest,
                               InMemoryReadTest,
+                              InMemoryBackendTest,
                               ReadTest,
                               FormatConversionTest)
 
@@ -63,6 +63,7 @@ import combinearchive.custom_zip as zipfile
 from tempfile import TemporaryFile
 from random import randint, random
 from unittest import skipUnless
+from test.test_support import captured_stdout
 
 from tests.custom_support import TESTFN, run_unittest, findfile, unlink
 
@@ -565,12 +566,12 @@ class TestZip64InSmallFiles(unittest.TestCase):
         zipfile.ZIP64_LIMIT = 5
 
     def large_file_exception_test(self, f, compression):
-        with zipfile.ZipFile(f, "w", compression) as zipfp:
+        with zipfile.ZipFile(f, "w", compression, allowZip64=False) as zipfp:
             self.assertRaises(zipfile.LargeZipFile,
                               zipfp.write, TESTFN, "another.name")
 
     def large_file_exception_test2(self, f, compression):
-        with zipfile.ZipFile(f, "w", compression) as zipfp:
+        with zipfile.ZipFile(f, "w", compression, allowZip64=False) as zipfp:
             self.assertRaises(zipfile.LargeZipFile,
                               zipfp.writestr, "another.name", self.data)
         if not isinstance(f, str):
@@ -579,6 +580,8 @@ class TestZip64InSmallFiles(unittest.TestCase):
     def test_large_file_exception(self):
         for f in (TESTFN2, TemporaryFile(), io.BytesIO()):
             self.large_file_exception_test(f, zipfile.ZIP_STORED)
+        # an empty archive in front would already exceed the lowered limit
+        for f in (TESTFN2, TemporaryFile(), io.BytesIO()):
             self.large_file_exception_test2(f, zipfile.ZIP_STORED)
 
     def zip_test(self, f, compression):
@@ -657,6 +660,62 @@ class TestZip64InSmallFiles(unittest.TestCase):
         with zipfile.ZipFile(TESTFN2, "r", zipfile.ZIP_STORED) as zipfp:
             self.assertEqual(zipfp.namelist(), ["absolute"])
 
+    def zip64_extras(self, zinfo):
+        extra = zinfo.extra
+        ids = []
+        while extra:
+            xid, xlen = struct.unpack('<HH', extra[:4])
+            ids.append(xid)
+            extra = extra[4 + xlen:]
+        return ids.count(1)
+
+    def test_remove_and_append(self):
+        # ZIP64 is used by default
+        with zipfile.ZipFile(TESTFN2, "w") as zipfp:
+            zipfp.write(TESTFN, "first")
+            zinfo = zipfile.ZipInfo("described")
+            zinfo.flag_bits |= 0x08
+            zipfp.writestr(zinfo, self.data)
+            zipfp.writestr("last", self.data)
+
+        with zipfile.ZipFile(TESTFN2, "a") as zipfp:
+            # the following members are moved including the ZIP64 data
+            # descriptor of "described"
+            zipfp.remove("first")
+            zipfp.writestr("new", self.data)
+
+        with zipfile.ZipFile(TESTFN2, "a") as zipfp:
+            zipfp.writestr(zipfp.getinfo("last"), zipfp.read("last"))
+
+        with zipfile.ZipFile(TESTFN2, "r") as zipfp:
+            self.assertEqual(zipfp.namelist(),
+                             ["described", "last", "new", "last"])
+            self.assertIsNone(zipfp.testzip())
+            for zinfo in zipfp.infolist():
+                self.assertEqual(zipfp.read(zinfo), self.data)
+                # old ZIP64 fields are replaced, not duplicated
+                self.assertEqual(self.zip64_extras(zinfo), 1)
+
+    def test_file_count(self):
+        # only the number of files exceeds a limit
+        zipfile.ZIP64_LIMIT = self._limit
+        limit = zipfile.ZIP_FILECOUNT_LIMIT
+        zipfile.ZIP_FILECOUNT_LIMIT = 10
+        try:
+            with zipfile.ZipFile(TESTFN2, "w", allowZip64=False) as zipfp:
+                for x in range(9):
+                    zipfp.writestr("%d" % x, b"")
+                self.assertRaises(zipfile.LargeZipFile,
+                                  zipfp.writestr, "9", b"")
+
+            with zipfile.ZipFile(TESTFN2, "w") as zipfp:
+                for x in range(20):
+                    zipfp.writestr("%d" % x, b"")
+            with zipfile.ZipFile(TESTFN2, "r") as zipfp:
+                self.assertEqual(len(zipfp.namelist()), 20)
+        finally:
+            zipfile.ZIP_FILECOUNT_LIMIT = limit
+
     def tearDown(self):
         zipfile.ZIP64_LIMIT = self._limit
         unlink(TESTFN)
@@ -755,6 +814,44 @@ class PyZipFileTests(unittest.TestCase):
         finally:
             shutil.rmtree(TESTFN2)
 
+    def test_write_workers(self):
+        os.mkdir(TESTFN2)
+        try:
+            os.mkdir(os.path.join(TESTFN2, "sub"))
+            for name in ("__init__", "zmod", "amod", "broken",
+                         "sub/__init__", "sub/mod"):
+                with open(os.path.join(TESTFN2, name + ".py"), "w") as fp:
+                    if name == "broken":
+                        fp.write("print(42\n")
+                    else:
+                        fp.write("value = %r\n" % name)
+
+            with TemporaryFile() as t, zipfile.PyZipFile(t, "w") as zipfp:
+                with captured_stdout() as output:
+                    zipfp.writepy(TESTFN2, workers=2)
+                self.assertIn("SyntaxError", output.getvalue())
+                names = zipfp.namelist()
+                # the broken module is added as source
+                base = os.path.basename(TESTFN2)
+                self.assertEqual([name.split("/", 1)[1] for name in names],
+                                 ["__init__.pyc", "amod.pyc", "broken.py",
+                                  "sub/__init__.pyc", "sub/mod.pyc",
+                                  "zmod.pyc"])
+                self.assertTrue(all(name.startswith(base + "/")
+                                    for name in names))
+
+            # up to date modules are not compiled again
+            pyc = os.path.join(TESTFN2, "amod.pyc")
+            os.utime(pyc, (time.time() + 100, time.time() + 100))
+            mtime = os.stat(pyc).st_mtime
+            with TemporaryFile() as t, zipfile.PyZipFile(t, "w") as zipfp:
+                with captured_stdout():
+                    zipfp.writepy(TESTFN2, workers=2)
+                self.assertEqual(zipfp.namelist(), names)
+            self.assertEqual(os.stat(pyc).st_mtime, mtime)
+        finally:
+            shutil.rmtree(TESTFN2)
+
     def test_write_non_pyfile(self):
         with TemporaryFile() as t, zipfile.PyZipFile(t, "w") as zipfp:
             with open(TESTFN, 'w') as f:
@@ -1157,6 +1254,17 @@ class DecryptionTests(unittest.TestCase):
         self.assertRaises(TypeError, self.zip.open, "test.txt", pwd=u"python")
         self.assertRaises(TypeError, self.zip.extract, "test.txt", pwd=u"python")
 
+    def test_bulk_decrypt(self):
+        data = os.urandom(4096)
+        bytewise = zipfile._ZipDecrypter(b"python")
+        bulk = zipfile._ZipDecrypter(b"python")
+        expected = b''.join(chr(c) for c in map(bytewise, data))
+        # the key state is carried over between chunks
+        self.assertEqual(bulk.decrypt(data[:1000]) + bulk.decrypt(data[1000:]),
+                         expected)
+        self.assertEqual((bulk.key0, bulk.key1, bulk.key2),
+                         (bytewise.key0, bytewise.key1, bytewise.key2))
+
 
 class TestsWithRandomBinaryFiles(unittest.TestCase):
     def setUp(self):
@@ -1639,11 +1747,1389 @@ class RemoveTests(unittest.TestCase):
         unlink(TESTFN)
 
 
+class DataOffsetTests(unittest.TestCase):
+    def setUp(self):
+        with zipfile.ZipFile(TESTFN, "w") as zf:
+            zf.writestr("foo.txt", "O, for a Muse of Fire!")
+            zf.writestr("bar.txt", "that would ascend")
+            # writing a member already knows where its data starts
+            zinfo = zf.getinfo("bar.txt")
+            self.assertEqual(zinfo._data_offset,
+                             zinfo.header_offset + len(zinfo.FileHeader()))
+
+    def test_lazy_offsets(self):
+        with zipfile.ZipFile(TESTFN, "r") as zf:
+            zinfo = zf.getinfo("foo.txt")
+            self.assertIsNone(zinfo._data_offset)
+            self.assertEqual(zf.read("foo.txt"), "O, for a Muse of Fire!")
+            self.assertEqual(zinfo._data_offset,
+                             zinfo.header_offset + len(zinfo.FileHeader()))
+            self.assertIsNone(zf.getinfo("bar.txt")._data_offset)
+
+    def test_cached_offset_skips_header(self):
+        with open(TESTFN, "rb") as fp:
+            data = fp.read()
+        fp = io.BytesIO(data)
+        with zipfile.ZipFile(fp, "r") as zf:
+            self.assertEqual(zf.read("foo.txt"), "O, for a Muse of Fire!")
+            # break the local header, the cached offset does not need it
+            fp.seek(zf.getinfo("foo.txt").header_offset)
+            fp.write(b"XXXX")
+            self.assertEqual(zf.read("foo.txt"), "O, for a Muse of Fire!")
+
+    def test_preload_headers(self):
+        with zipfile.ZipFile(TESTFN, "r", preload_headers=True) as zf:
+            for zinfo in zf.infolist():
+                self.assertEqual(zinfo._data_offset,
+                                 zinfo.header_offset + len(zinfo.FileHeader()))
+            self.assertEqual(zf.read("bar.txt"), "that would ascend")
+
+    def test_preload_headers_bad_header(self):
+        with zipfile.ZipFile(TESTFN, "r") as zf:
+            offset = zf.getinfo("bar.txt").header_offset
+        with open(TESTFN, "r+b") as fp:
+            fp.seek(offset)
+            fp.write(b"XXXX")
+
+        with self.assertRaises(zipfile.BadZipFile):
+            zipfile.ZipFile(TESTFN, "r", preload_headers=True)
+
+    def test_offsets_after_remove(self):
+        with zipfile.ZipFile(TESTFN, "a") as zf:
+            zf.read("bar.txt")
+            zf.remove("foo.txt")
+            zinfo = zf.getinfo("bar.txt")
+            self.assertEqual(zinfo._data_offset,
+                             zinfo.header_offset + len(zinfo.FileHeader()))
+            self.assertEqual(zf.read("bar.txt"), "that would ascend")
+
+    def tearDown(self):
+        unlink(TESTFN)
+
+
+class FreeSpaceTests(unittest.TestCase):
+    fname_list = ["foo.txt", "bar.txt", "blubb.bla", "sup.bro"]
+    data_list = ["a" * 200, "b" * 100, "c" * 300, "d" * 50]
+
+    def setUp(self):
+        with zipfile.ZipFile(TESTFN, "w") as zf:
+            for fname, data in zip(self.fname_list, self.data_list):
+                zf.writestr(fname, data)
+
+    def check_contents(self, expected):
+        with zipfile.ZipFile(TESTFN, "r") as zf:
+            self.assertEqual(sorted(zf.namelist()), sorted(expected))
+            for fname, data in expected.items():
+                self.assertEqual(zf.read(fname), data)
+            self.assertIsNone(zf.testzip())
+
+    def test_release_and_allocate(self):
+        free = zipfile._FreeSpace()
+        free.release(100, 10)
+        free.release(200, 50)
+        free.release(110, 20)   # merges with the first extent
+        self.assertEqual(free.extents, [(100, 30), (200, 50)])
+        self.assertEqual(free.allocate(25), 100)    # best fit
+        self.assertEqual(free.extents, [(125, 5), (200, 50)])
+        self.assertEqual(free.allocate(50), 200)
+        self.assertIsNone(free.allocate(6))
+        self.assertEqual(free.trim(130), 125)
+        self.assertEqual(free.extents, [])
+
+    def test_remove_leaves_hole(self):
+        size = os.path.getsize(TESTFN)
+        with zipfile.ZipFile(TESTFN, "a", reuse_space=True) as zf:
+            offset = zf.getinfo("bar.txt").header_offset
+            zf.remove("bar.txt")
+            self.assertEqual(zf._free.extents[0][0], offset)
+            # the hole gets filled by a smaller member
+            zf.writestr("new.txt", "e" * 80)
+            self.assertEqual(zf.getinfo("new.txt").header_offset, offset)
+        self.assertEqual(os.path.getsize(TESTFN), size)
+
+        expected = dict(zip(self.fname_list, self.data_list))
+        del expected["bar.txt"]
+        expected["new.txt"] = "e" * 80
+        self.check_contents(expected)
+
+    def test_best_fit(self):
+        with zipfile.ZipFile(TESTFN, "a", reuse_space=True) as zf:
+            zf.remove("foo.txt")
+            zf.remove("blubb.bla")
+            # the removed foo.txt is the smallest hole still large enough
+            zf.writestr("new.txt", "e" * 150)
+            self.assertEqual(zf.getinfo("new.txt").header_offset, 0)
+
+    def test_holes_found_on_open(self):
+        with zipfile.ZipFile(TESTFN, "a", reuse_space=True) as zf:
+            offset = zf.getinfo("blubb.bla").header_offset
+            zf.remove("blubb.bla")
+        with zipfile.ZipFile(TESTFN, "a", reuse_space=True) as zf:
+            self.assertEqual(len(zf._free), 1)
+            self.assertEqual(zf._free.extents[0][0], offset)
+            zf.writestr("new.txt", "e" * 300)
+            self.assertEqual(zf.getinfo("new.txt").header_offset, offset)
+
+        expected = dict(zip(self.fname_list, self.data_list))
+        del expected["blubb.bla"]
+        expected["new.txt"] = "e" * 300
+        self.check_contents(expected)
+
+    def test_remove_last_shrinks(self):
+        with zipfile.ZipFile(TESTFN, "a", reuse_space=True) as zf:
+            zf.remove("blubb.bla")
+            size = os.path.getsize(TESTFN)
+            offset = zf.getinfo("sup.bro").header_offset
+            # the hole in front of sup.bro is merged and dropped as well
+            zf.remove("sup.bro")
+            self.assertEqual(len(zf._free), 0)
+        self.assertLess(os.path.getsize(TESTFN), size)
+        with zipfile.ZipFile(TESTFN, "r") as zf:
+            self.assertLess(zf.start_dir, offset)
+
+    def test_compact_after_holes(self):
+        # fill a hole, so the physical order differs from the directory
+        with zipfile.ZipFile(TESTFN, "a", reuse_space=True) as zf:
+            zf.remove("foo.txt")
+            zf.writestr("new.txt", "e" * 20)
+        # shifting members has to follow the physical order
+        with zipfile.ZipFile(TESTFN, "a") as zf:
+            zf.remove("bar.txt")
+
+        expected = dict(zip(self.fname_list, self.data_list))
+        del expected["foo.txt"]
+        del expected["bar.txt"]
+        expected["new.txt"] = "e" * 20
+        self.check_contents(expected)
+
+    def tearDown(self):
+        unlink(TESTFN)
+
+
+class ReplaceTests(unittest.TestCase):
+    def setUp(self):
+        with zipfile.ZipFile(TESTFN, "w") as zf:
+            zf.writestr("manifest.xml", "a" * 100, reserve=64)
+            zf.writestr("data.bin", "b" * 1000)
+
+    def test_reserve_pads_local_header(self):
+        with zipfile.ZipFile(TESTFN, "r") as zf:
+            zinfo = zf.getinfo("manifest.xml")
+            self.assertEqual(zf.read("manifest.xml"), "a" * 100)
+            self.assertEqual(zinfo._data_offset - zinfo.header_offset,
+                             len(zinfo.FileHeader()) + 64)
+            # the padding is not part of the central directory
+            self.assertEqual(zinfo.extra, b"")
+
+    def test_replace_in_place(self):
+        size = os.path.getsize(TESTFN)
+        with zipfile.ZipFile(TESTFN, "a") as zf:
+            offset = zf.getinfo("data.bin").header_offset
+            zinfo = zf.replace("manifest.xml", "c" * 160)
+            self.assertEqual(zinfo.header_offset, 0)
+            self.assertIs(zf.getinfo("manifest.xml"), zinfo)
+            self.assertEqual(zf.getinfo("data.bin").header_offset, offset)
+            self.assertEqual(zf.read("manifest.xml"), "c" * 160)
+        self.assertEqual(os.path.getsize(TESTFN), size)
+
+        with zipfile.ZipFile(TESTFN, "a") as zf:
+            # the remaining padding can still be used
+            zf.replace("manifest.xml", "d" * 10)
+            zf.replace("manifest.xml", "e" * 164)
+            self.assertEqual(zf.getinfo("manifest.xml").header_offset, 0)
+        self.assertEqual(os.path.getsize(TESTFN), size)
+
+        with zipfile.ZipFile(TESTFN, "r") as zf:
+            self.assertEqual(zf.namelist(), ["manifest.xml", "data.bin"])
+            self.assertEqual(zf.read("manifest.xml"), "e" * 164)
+            self.assertEqual(zf.read("data.bin"), "b" * 1000)
+            self.assertIsNone(zf.testzip())
+
+    def test_replace_shrinks(self):
+        for reuse_space in (False, True):
+            with zipfile.ZipFile(TESTFN, "w") as zf:
+                zf.writestr("big", "x" * 100000)
+                zf.writestr("last", "l" * 10)
+            size = os.path.getsize(TESTFN)
+            with zipfile.ZipFile(TESTFN, "a", reuse_space=reuse_space) as zf:
+                old_end = zf._member_end(zf.getinfo("big"))
+                # most of the old record does not fit into the padding
+                zinfo = zf.replace("big", "y" * 10)
+                self.assertEqual(zinfo.header_offset, 0)
+                hole = (zinfo._data_offset + 10,
+                        old_end - zinfo._data_offset - 10)
+                if reuse_space:
+                    self.assertEqual(zf._free.extents, [hole])
+                    # the rest is filled by the next member
+                    zf.writestr("new", "z" * 20000)
+                    self.assertEqual(zf.getinfo("new").header_offset, hole[0])
+            # only the central directory grows
+            self.assertLess(os.path.getsize(TESTFN), size + 100)
+            if not reuse_space:
+                # the hole is found, when the archive is opened with reuse_space
+                with zipfile.ZipFile(TESTFN, "a", reuse_space=True) as zf:
+                    self.assertEqual(zf._free.extents, [hole])
+            with zipfile.ZipFile(TESTFN, "r") as zf:
+                self.assertIsNone(zf.testzip())
+                self.assertEqual(zf.read("big"), "y" * 10)
+                self.assertEqual(zf.read("last"), "l" * 10)
+
+    def test_replace_relocates(self):
+        with zipfile.ZipFile(TESTFN, "a") as zf:
+            zf.replace("manifest.xml", "c" * 200, reserve=32)
+            zinfo = zf.getinfo("manifest.xml")
+            self.assertEqual(zf.getinfo("data.bin").header_offset, 0)
+            self.assertGreater(zinfo.header_offset, 0)
+            self.assertEqual(zinfo._data_offset - zinfo.header_offset,
+                             len(zinfo.FileHeader()))
+
+        with zipfile.ZipFile(TESTFN, "r") as zf:
+            self.assertEqual(zf.read("manifest.xml"), "c" * 200)
+            self.assertEqual(zf.read("data.bin"), "b" * 1000)
+
+    def test_replace_last_member(self):
+        with zipfile.ZipFile(TESTFN, "a") as zf:
+            offset = zf.getinfo("data.bin").header_offset
+            zf.replace("data.bin", "f" * 5000)
+            self.assertEqual(zf.getinfo("data.bin").header_offset, offset)
+            zf.replace("data.bin", "g" * 10)
+            self.assertEqual(zf.getinfo("data.bin").header_offset, offset)
+
+        with zipfile.ZipFile(TESTFN, "r") as zf:
+            self.assertEqual(zf.read("data.bin"), "g" * 10)
+            self.assertEqual(zf.start_dir, offset + len(zf.getinfo("data.bin").FileHeader()) + 10)
+
+    def test_replace_new_member(self):
+        with zipfile.ZipFile(TESTFN, "a") as zf:
+            zf.replace("new.txt", "h" * 10)
+        with zipfile.ZipFile(TESTFN, "r") as zf:
+            self.assertEqual(zf.read("new.txt"), "h" * 10)
+
+    def test_reserve_too_large(self):
+        with zipfile.ZipFile(TESTFN, "a") as zf:
+            with self.assertRaises(ValueError):
+                zf.writestr("new.txt", "h", reserve=1 << 16)
+
+    def tearDown(self):
+        unlink(TESTFN)
+
+
+class RenameTests(unittest.TestCase):
+    def setUp(self):
+        with zipfile.ZipFile(TESTFN, "w") as zf:
+            zf.writestr("model.xml", b"model" * 100)
+            zf.writestr("data.csv", b"1,2,3\n" * 100, zipfile.ZIP_DEFLATED)
+            zf.writestr("last.txt", b"last")
+        self.size = os.path.getsize(TESTFN)
+
+    def check(self, names):
+        with zipfile.ZipFile(TESTFN, "r") as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(zf.namelist(), names)
+            self.assertEqual(zf.read(names[0]), b"model" * 100)
+            self.assertEqual(zf.read(names[1]), b"1,2,3\n" * 100)
+
+    def test_in_place(self):
+        with zipfile.ZipFile(TESTFN, "a") as zf:
+            offset = zf.getinfo("model.xml").header_offset
+            zinfo = zf.rename("model.xml", "MODEL.XML")
+            self.assertEqual(zinfo.header_offset, offset)
+            # four bytes shorter, the rest is padding
+            offset = zf.getinfo("data.csv").header_offset
+            self.assertEqual(zf.rename("data.csv", "data").header_offset,
+                             offset)
+        # only the name in the central directory got shorter
+        self.assertEqual(os.path.getsize(TESTFN), self.size - 4)
+        self.check(["MODEL.XML", "data", "last.txt"])
+
+    def test_relocate(self):
+        with zipfile.ZipFile(TESTFN, "a") as zf:
+            last = zf.getinfo("last.txt").header_offset
+            zinfo = zf.rename("model.xml", "models/model.xml")
+            self.assertGreater(zinfo.header_offset, last)
+            zf.rename("data.csv", "dat.csv")
+        self.check(["models/model.xml", "dat.csv", "last.txt"])
+
+        # members behind the unused space can still be removed
+        with zipfile.ZipFile(TESTFN, "a") as zf:
+            zf.remove("last.txt")
+        self.check(["models/model.xml", "dat.csv"])
+
+    def test_reuse_space(self):
+        with zipfile.ZipFile(TESTFN, "a", reuse_space=True) as zf:
+            zf.remove("model.xml")
+            zf.writestr("x", b"x")
+            zf.rename("last.txt", "a/much/longer/name.txt")
+            self.assertLess(zf.getinfo("a/much/longer/name.txt").header_offset,
+                            zf.getinfo("data.csv").header_offset)
+        with zipfile.ZipFile(TESTFN, "r") as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(zf.read("a/much/longer/name.txt"), b"last")
+
+    def test_aligned(self):
+        with zipfile.ZipFile(TESTFN, "a") as zf:
+            zf.writestr("aligned.bin", b"a" * 100, align=4096)
+            zf.rename("aligned.bin", "results/aligned.bin")
+        with zipfile.ZipFile(TESTFN, "r") as zf:
+            zinfo = zf.getinfo("results/aligned.bin")
+            self.assertEqual(zf._resolve_data_offset(zinfo) % 4096, 0)
+            self.assertEqual(zf.read(zinfo), b"a" * 100)
+
+    def test_durability(self):
+        with open(TESTFN, "rb") as fp:
+            original = fp.read()
+        with zipfile.ZipFile(TESTFN, "a",
+                             durability=zipfile.DURABILITY_FSYNC) as zf:
+            zf.rename("model.xml", "MODEL.XML")
+            zf.fp.flush()
+            with open(TESTFN, "rb") as fp:
+                self.assertEqual(fp.read(self.size), original)
+        self.check(["MODEL.XML", "data.csv", "last.txt"])
+
+    def test_errors(self):
+        with zipfile.ZipFile(TESTFN, "a") as zf:
+            self.assertRaises(ValueError, zf.rename, "model.xml", "last.txt")
+            self.assertRaises(KeyError, zf.rename, "missing", "other")
+        with zipfile.ZipFile(TESTFN, "r") as zf:
+            self.assertRaises(RuntimeError, zf.rename, "model.xml", "other")
+
+    def tearDown(self):
+        unlink(TESTFN)
+
+
+class DurabilityTests(unittest.TestCase):
+    def setUp(self):
+        with zipfile.ZipFile(TESTFN, "w") as zf:
+            zf.writestr("manifest.xml", "a" * 100)
+            zf.writestr("data.bin", "b" * 1000)
+        with open(TESTFN, "rb") as fp:
+            self.original = fp.read()
+        self.size = len(self.original)
+
+    def test_old_directory_stays_valid(self):
+        with zipfile.ZipFile(TESTFN, "a",
+                             durability=zipfile.DURABILITY_FSYNC) as zf:
+            zf.writestr("new.txt", "c" * 10)
+            zf.replace("manifest.xml", "d" * 50)
+            zf.remove("data.bin")
+            zf.fp.flush()
+
+            # nothing of the old archive was overwritten
+            with open(TESTFN, "rb") as fp:
+                self.assertEqual(fp.read(self.size), self.original)
+            shutil.copy(TESTFN, TESTFN2)
+            with open(TESTFN2, "r+b") as fp:
+                fp.truncate(self.size)
+            with zipfile.ZipFile(TESTFN2, "r") as old:
+                self.assertEqual(old.namelist(), ["manifest.xml", "data.bin"])
+                self.assertEqual(old.read("manifest.xml"), "a" * 100)
+
+        with zipfile.ZipFile(TESTFN, "r") as zf:
+            self.assertEqual(zf.namelist(), ["new.txt", "manifest.xml"])
+            self.assertEqual(zf.read("manifest.xml"), "d" * 50)
+            self.assertIsNone(zf.testzip())
+
+    def test_journal_rollback(self):
+        zf = zipfile.ZipFile(TESTFN, "a", durability=zipfile.DURABILITY_JOURNAL)
+        self.assertFalse(os.path.exists(TESTFN + ".journal"))
+        zf.writestr("new.txt", "c" * 1000)
+        zf.fp.flush()
+        self.assertTrue(os.path.exists(TESTFN + ".journal"))
+
+        # simulate a crash by copying the archive and its journal
+        shutil.copy(TESTFN, TESTFN2)
+        shutil.copy(TESTFN + ".journal", TESTFN2 + ".journal")
+        zf.close()
+        self.assertFalse(os.path.exists(TESTFN + ".journal"))
+
+        with zipfile.ZipFile(TESTFN2, "a") as zf:
+            self.assertEqual(zf.namelist(), ["manifest.xml", "data.bin"])
+        self.assertFalse(os.path.exists(TESTFN2 + ".journal"))
+        self.assertEqual(os.path.getsize(TESTFN2), self.size)
+
+    def test_journal_after_commit(self):
+        with zipfile.ZipFile(TESTFN, "a",
+                             durability=zipfile.DURABILITY_JOURNAL) as zf:
+            zf.writestr("new.txt", "c" * 1000)
+            shutil.copy(TESTFN + ".journal", TESTFN2)
+        # the commit completed, only the journal was left behind
+        shutil.copy(TESTFN2, TESTFN + ".journal")
+
+        with zipfile.ZipFile(TESTFN, "a",
+                             durability=zipfile.DURABILITY_JOURNAL) as zf:
+            self.assertEqual(zf.namelist(),
+                             ["manifest.xml", "data.bin", "new.txt"])
+        self.assertFalse(os.path.exists(TESTFN + ".journal"))
+
+    def test_torn_directory(self):
+        with zipfile.ZipFile(TESTFN, "a",
+                             durability=zipfile.DURABILITY_FSYNC) as zf:
+            zf.writestr("new.txt", "c" * 1000)
+        size = os.path.getsize(TESTFN)
+        # a modification, whose central directory was not written completely
+        with open(TESTFN, "ab") as fp:
+            fp.write("e" * 70000 + zipfile.stringCentralDir + "f" * 20)
+
+        with zipfile.ZipFile(TESTFN, "a",
+                             durability=zipfile.DURABILITY_FSYNC) as zf:
+            self.assertEqual(zf.namelist(),
+                             ["manifest.xml", "data.bin", "new.txt"])
+        self.assertEqual(os.path.getsize(TESTFN), size)
+
+    def test_reuse_space(self):
+        with zipfile.ZipFile(TESTFN, "a", reuse_space=True,
+                             durability=zipfile.DURABILITY_FSYNC) as zf:
+            zf.remove("manifest.xml")
+        with zipfile.ZipFile(TESTFN, "a", reuse_space=True,
+                             durability=zipfile.DURABILITY_FSYNC) as zf:
+            # holes are used after the commit of the removal
+            zinfo = zf.writestr("manifest.xml", "g" * 50)
+            self.assertLess(zinfo.header_offset, zf.start_dir)
+        with zipfile.ZipFile(TESTFN, "r") as zf:
+            self.assertEqual(zf.read("manifest.xml"), "g" * 50)
+            self.assertIsNone(zf.testzip())
+
+    def test_journal_requires_name(self):
+        with self.assertRaises(RuntimeError):
+            zipfile.ZipFile(io.BytesIO(), "w",
+                            durability=zipfile.DURABILITY_JOURNAL)
+        with self.assertRaises(RuntimeError):
+            zipfile.ZipFile(TESTFN, "a", durability=3)
+
+    def tearDown(self):
+        unlink(TESTFN)
+        unlink(TESTFN2)
+        unlink(TESTFN + ".journal")
+        unlink(TESTFN2 + ".journal")
+
+
+class VerifyTests(unittest.TestCase):
+    def setUp(self):
+        with zipfile.ZipFile(TESTFN, "w") as zf:
+            for x in range(20):
+                compression = zipfile.ZIP_DEFLATED if x % 2 else zipfile.ZIP_STORED
+                zf.writestr("%02d.txt" % x, ("%d " % x) * 1000,
+                            compress_type=compression)
+
+    def corrupt(self, *names):
+        with zipfile.ZipFile(TESTFN, "r") as zf:
+            offsets = [zf._resolve_data_offset(zf.getinfo(name))
+                       for name in names]
+        with open(TESTFN, "r+b") as fp:
+            for offset in offsets:
+                fp.seek(offset + 10)
+                fp.write(b"\xff" * 4)
+
+    def test_all_good(self):
+        calls = []
+        with zipfile.ZipFile(TESTFN, "r") as zf:
+            self.assertEqual(zf.verify(workers=4,
+                                       progress=lambda *args: calls.append(args)), [])
+        self.assertEqual(calls[-1], (20, 20))
+        done = [call[0] for call in calls]
+        self.assertEqual(done, sorted(done))
+
+    def test_all_bad_members(self):
+        self.corrupt("03.txt", "10.txt", "17.txt")
+        with zipfile.ZipFile(TESTFN, "r") as zf:
+            for workers in (1, 4):
+                self.assertEqual(zf.verify(workers=workers),
+                                 ["03.txt", "10.txt", "17.txt"])
+            # testzip() still stops at the first one
+            self.assertEqual(zf.testzip(), "03.txt")
+
+    def test_file_object(self):
+        self.corrupt("05.txt")
+        calls = []
+        with open(TESTFN, "rb") as fp:
+            with zipfile.ZipFile(fp, "r") as zf:
+                self.assertEqual(zf.verify(workers=4,
+                                           progress=lambda *args: calls.append(args)),
+                                 ["05.txt"])
+        self.assertEqual(len(calls), 20)
+
+    def tearDown(self):
+        unlink(TESTFN)
+
+
+class VerifyPolicyTests(VerifyTests):
+    def test_never(self):
+        self.corrupt("03.txt", "04.txt")
+        with zipfile.ZipFile(TESTFN, "r",
+                             verify_crc=zipfile.VERIFY_NEVER) as zf:
+            self.assertEqual(len(zf.read("04.txt")), 2000)
+            self.assertEqual(zf.open("03.txt").read(1), b"3")
+            # explicit checks are not affected
+            self.assertEqual(zf.testzip(), "03.txt")
+            self.assertEqual(zf.verify(), ["03.txt", "04.txt"])
+
+    def test_deferred_callback(self):
+        # corrupt stored members, so only the CRC check can tell
+        self.corrupt("04.txt", "08.txt")
+        errors = []
+        with zipfile.ZipFile(TESTFN, "r", verify_crc=zipfile.VERIFY_DEFERRED,
+                             on_crc_error=errors.append) as zf:
+            for name in zf.namelist():
+                data = zf.read(name)
+                if name not in ("04.txt", "08.txt"):
+                    self.assertEqual(data, ("%d " % int(name[:2])) * 1000)
+            # reading again does not check again
+            zf.read("04.txt")
+        self.assertEqual(sorted(errors), ["04.txt", "08.txt"])
+
+    def test_deferred_remove(self):
+        # checks still queued must not read the moved records
+        data = [os.urandom(1 << 22) for x in range(5)]
+        with zipfile.ZipFile(TESTFN2, "w") as zf:
+            zf.writestr("first", b"first" * 1000)
+            for x in range(5):
+                zf.writestr("big%d" % x, data[x])
+        errors = []
+        try:
+            with zipfile.ZipFile(TESTFN2, "a", verify_crc=zipfile.VERIFY_DEFERRED,
+                                 on_crc_error=errors.append) as zf:
+                for x in range(5):
+                    zf.open("big%d" % x).close()
+                zf.remove("first")
+            self.assertEqual(errors, [])
+            with zipfile.ZipFile(TESTFN2, "r") as zf:
+                self.assertIsNone(zf.testzip())
+                self.assertEqual(zf.read("big4"), data[4])
+        finally:
+            unlink(TESTFN2)
+
+    def test_deferred_raise(self):
+        self.corrupt("04.txt")
+        zf = zipfile.ZipFile(TESTFN, "r", verify_crc=zipfile.VERIFY_DEFERRED)
+        zf.read("04.txt")
+        zf._verifier.wait()
+        with self.assertRaises(zipfile.BadZipFile):
+            zf.read("05.txt")
+        # the error is reported only once
+        self.assertEqual(len(zf.read("05.txt")), 2000)
+        zf.close()
+
+        zf = zipfile.ZipFile(TESTFN, "r", verify_crc=zipfile.VERIFY_DEFERRED)
+        zf.read("04.txt")
+        with self.assertRaises(zipfile.BadZipFile):
+            zf.close()
+        self.assertIsNone(zf.fp)
+
+    def test_deferred_good(self):
+        with zipfile.ZipFile(TESTFN, "a", verify_crc=zipfile.VERIFY_DEFERRED) as zf:
+            for name in zf.namelist():
+                zf.read(name)
+            zf.writestr("new.txt", b"new")
+        with zipfile.ZipFile(TESTFN, "r") as zf:
+            self.assertIsNone(zf.testzip())
+
+    def test_deferred_file_object(self):
+        # without a file name, members are checked while they are read
+        self.corrupt("04.txt")
+        with open(TESTFN, "rb") as fp:
+            with zipfile.ZipFile(fp, "r", verify_crc=zipfile.VERIFY_DEFERRED) as zf:
+                self.assertRaises(zipfile.BadZipFile, zf.read, "04.txt")
+
+    def test_bad_policy(self):
+        self.assertRaises(RuntimeError, zipfile.ZipFile, TESTFN, "r",
+                          verify_crc=3)
+
+
+class CountingFile(object):
+    """Wrap a file object and count the calls of flush() and seek()."""
+    def __init__(self, fp):
+        self.fp = fp
+        self.flushes = 0
+        self.seeks = 0
+
+    def flush(self):
+        self.flushes += 1
+        self.fp.flush()
+
+    def seek(self, *args):
+        self.seeks += 1
+        return self.fp.seek(*args)
+
+    def __getattr__(self, name):
+        return getattr(self.fp, name)
+
+
+class FlushPolicyTests(unittest.TestCase):
+    def setUp(self):
+        with open(TESTFN2, "wb") as fp:
+            fp.write(b"source data\n" * 1000)
+
+    def write_members(self, zf, count=100):
+        for x in range(count):
+            zf.writestr("str%d.txt" % x, b"%d" % x)
+            zf.write(TESTFN2, "file%d.txt" % x, zipfile.ZIP_DEFLATED)
+
+    def check(self, count=100):
+        with zipfile.ZipFile(TESTFN, "r") as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(len(zf.namelist()), 2 * count)
+            self.assertEqual(zf.read("str%d.txt" % (count - 1)), b"%d" % (count - 1))
+
+    def test_policies(self):
+        for policy in (zipfile.FLUSH_MEMBER, zipfile.FLUSH_COMMIT,
+                       zipfile.FLUSH_NEVER):
+            with zipfile.ZipFile(TESTFN, "w", flush_policy=policy,
+                                 buffer_size=2 ** 20) as zf:
+                self.write_members(zf)
+            self.check()
+
+    def test_group_commit(self):
+        with io.open(TESTFN, "w+b") as fp:
+            counting = CountingFile(fp)
+            with zipfile.ZipFile(counting, "w",
+                                 flush_policy=zipfile.FLUSH_MEMBER) as zf:
+                self.write_members(zf)
+            self.assertGreaterEqual(counting.flushes, 200)
+        self.check()
+
+        with io.open(TESTFN, "w+b") as fp:
+            counting = CountingFile(fp)
+            with zipfile.ZipFile(counting, "w",
+                                 flush_policy=zipfile.FLUSH_COMMIT) as zf:
+                self.write_members(zf)
+            # a single flush and a single pass over the headers
+            self.assertLessEqual(counting.flushes, 2)
+            self.assertLessEqual(counting.seeks, 102)
+        self.check()
+
+    def test_read_modify_pending(self):
+        with zipfile.ZipFile(TESTFN, "w", flush_policy=zipfile.FLUSH_COMMIT) as zf:
+            self.write_members(zf, 3)
+            # pending headers are written before members are read
+            self.assertEqual(zf.read("file1.txt"), b"source data\n" * 1000)
+            zf.write(TESTFN2, "last.txt")
+        with zipfile.ZipFile(TESTFN, "a", flush_policy=zipfile.FLUSH_NEVER) as zf:
+            zf.write(TESTFN2, "new.txt")
+            zf.remove("file0.txt")
+            zf.write(TESTFN2, "file0.txt")
+            zf.replace("str0.txt", b"replaced")
+        with zipfile.ZipFile(TESTFN, "r") as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(zf.read("file0.txt"), b"source data\n" * 1000)
+            self.assertEqual(zf.read("str0.txt"), b"replaced")
+
+    def test_bad_policy(self):
+        self.assertRaises(RuntimeError, zipfile.ZipFile, TESTFN, "w",
+                          flush_policy=3)
+
+    def tearDown(self):
+        unlink(TESTFN)
+        unlink(TESTFN2)
+
+
+class AlignmentTests(unittest.TestCase):
+    def test_writestr(self):
+        with zipfile.ZipFile(TESTFN, "w") as zf:
+            for x in range(10):
+                zf.writestr("%d.bin" % x, b"%d" % x * randint(1, 5000),
+                            align=4096)
+            zf.writestr("reserved.bin", b"data", reserve=100, align=4096)
+            zf.writestr("name" * 10, b"data", align=4)
+            zf.writestr("deflated.bin", b"data", zipfile.ZIP_DEFLATED, align=4096)
+        with zipfile.ZipFile(TESTFN, "r") as zf:
+            self.assertIsNone(zf.testzip())
+            for zinfo in zf.infolist():
+                if zinfo.compress_type == zipfile.ZIP_STORED:
+                    align = 4 if zinfo.filename.startswith("name") else 4096
+                    self.assertEqual(zf._resolve_data_offset(zinfo) % align, 0)
+                    self.assertEqual(bytes(zf.mmap(zinfo)), zf.read(zinfo))
+
+    def test_write(self):
+        with open(TESTFN2, "wb") as fp:
+            fp.write(b"file data" * 1000)
+        with zipfile.ZipFile(TESTFN, "w") as zf:
+            zf.writestr("first", b"first")
+            zf.write(TESTFN2, "second", align=4096)
+            zf.write(TESTFN2, "third", align=4096)
+        with zipfile.ZipFile(TESTFN, "r") as zf:
+            self.assertIsNone(zf.testzip())
+            for name in ("second", "third"):
+                zinfo = zf.getinfo(name)
+                self.assertEqual(zf._resolve_data_offset(zinfo) % 4096, 0)
+                self.assertEqual(bytes(zf.mmap(name)), b"file data" * 1000)
+
+    def test_holes_skipped(self):
+        with zipfile.ZipFile(TESTFN, "w") as zf:
+            zf.writestr("hole", b"x" * 10000)
+            zf.writestr("last", b"last")
+        with zipfile.ZipFile(TESTFN, "a", reuse_space=True) as zf:
+            zf.remove("hole")
+            zf.writestr("aligned", b"y" * 100, align=4096)
+            self.assertGreater(zf.getinfo("aligned").header_offset,
+                               zf.getinfo("last").header_offset)
+            self.assertEqual(bytes(zf.mmap("aligned")), b"y" * 100)
+
+    def test_remove_keeps_alignment(self):
+        with zipfile.ZipFile(TESTFN, "w") as zf:
+            zf.writestr("first", b"x" * 1234)
+            zf.writestr("aligned", b"y" * 5000, align=4096)
+            zf.writestr("small", b"z" * 10, align=8)
+            zf.writestr("last", b"last")
+        with zipfile.ZipFile(TESTFN, "a") as zf:
+            zf.remove("first")
+        with zipfile.ZipFile(TESTFN, "r") as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(zf._resolve_data_offset(zf.getinfo("aligned")) % 4096, 0)
+            self.assertEqual(zf._resolve_data_offset(zf.getinfo("small")) % 8, 0)
+            self.assertEqual(bytes(zf.mmap("aligned")), b"y" * 5000)
+            self.assertEqual(zf.read("last"), b"last")
+
+    def test_remove_many(self):
+        # the padding does not grow with each removal in front of the member
+        with zipfile.ZipFile(TESTFN, "w") as zf:
+            for x in range(40):
+                zf.writestr("s%d" % x, b"s" * randint(4000, 4200))
+            zf.writestr("aligned", b"a" * 5000, align=4096)
+            zf.writestr("last", b"last")
+        with zipfile.ZipFile(TESTFN, "a") as zf:
+            for x in range(40):
+                zf.remove("s%d" % x)
+                zinfo = zf.getinfo("aligned")
+                self.assertLess(zinfo._padding, 4096 + 6)
+                self.assertEqual(zinfo._data_offset % 4096, 0)
+        with zipfile.ZipFile(TESTFN, "r") as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(bytes(zf.mmap("aligned")), b"a" * 5000)
+            self.assertEqual(zf.read("last"), b"last")
+
+    def test_remove_unalignable(self):
+        # a member, which cannot be aligned, fails before anything is moved
+        with zipfile.ZipFile(TESTFN, "w") as zf:
+            zf.writestr("first", b"x" * 1234)
+            zf.writestr("second", b"y" * 1000)
+            zf.writestr("aligned", b"z" * 100, align=4096)
+        with zipfile.ZipFile(TESTFN, "a") as zf:
+            zinfo = zf.getinfo("aligned")
+            zinfo.extra = b"\0" * (zipfile._EXTRA_MAX_LENGTH - 100)
+            self.assertRaises(ValueError, zf.remove, "first")
+            zinfo.extra = b""
+        with zipfile.ZipFile(TESTFN, "r") as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(zf.namelist(), ["first", "second", "aligned"])
+
+    def test_mmap_errors(self):
+        data = io.BytesIO()
+        with zipfile.ZipFile(data, "w") as zf:
+            zf.writestr("stored", b"stored")
+            zf.writestr("deflated", b"deflated", zipfile.ZIP_DEFLATED)
+            zf.writestr("empty", b"")
+            self.assertRaises(ValueError, zf.mmap, "stored")
+            self.assertRaises(ValueError, zf.mmap, "deflated")
+            self.assertEqual(bytes(zf.mmap("empty")), b"")
+        self.assertRaises(RuntimeError, zf.mmap, "stored")
+
+    def test_bad_alignment(self):
+        with zipfile.ZipFile(TESTFN, "w") as zf:
+            self.assertRaises(ValueError, zf.writestr, "x", b"x",
+                              align=1 << 17)
+
+    def tearDown(self):
+        unlink(TESTFN)
+        unlink(TESTFN2)
+
+
+class NestedTests(unittest.TestCase):
+    def setUp(self):
+        inner = io.BytesIO()
+        with zipfile.ZipFile(inner, "w", zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr("model.xml", b"<model/>" * 100)
+            zf.writestr("data.csv", b"1,2,3\n" * 100)
+        self.inner = inner.getvalue()
+        with zipfile.ZipFile(TESTFN, "w") as zf:
+            zf.writestr("first.txt", b"first")
+            zf.writestr("stored.zip", self.inner)
+            zf.writestr("deflated.zip", self.inner, zipfile.ZIP_DEFLATED)
+            zf.writestr("plain.txt", b"not a zip file")
+
+    def check(self, nested):
+        self.assertEqual(nested.namelist(), ["model.xml", "data.csv"])
+        self.assertEqual(nested.read("model.xml"), b"<model/>" * 100)
+        self.assertIsNone(nested.testzip())
+
+    def test_stored(self):
+        with zipfile.ZipFile(TESTFN, "r") as zf:
+            nested = zf.open_nested("stored.zip")
+            self.assertIsInstance(nested.fp, zipfile._WindowFile)
+            self.check(nested)
+            window = nested.fp
+            nested.close()
+            self.assertTrue(window.closed)
+            self.assertEqual(zf.read("plain.txt"), b"not a zip file")
+
+    def test_deflated(self):
+        with zipfile.ZipFile(TESTFN, "r") as zf:
+            with zf.open_nested("deflated.zip") as nested:
+                self.assertNotIsInstance(nested.fp, zipfile._WindowFile)
+                self.check(nested)
+
+    def test_shared_file(self):
+        with open(TESTFN, "rb") as fp:
+            with zipfile.ZipFile(fp, "r") as zf:
+                with zf.open_nested("stored.zip") as nested:
+                    # the parent and the nested archive read alternately
+                    self.assertEqual(zf.read("first.txt"), b"first")
+                    self.check(nested)
+                    self.assertEqual(zf.read("plain.txt"), b"not a zip file")
+            self.assertFalse(fp.closed)
+
+    def test_window_file(self):
+        with open(TESTFN, "rb") as fp:
+            window = zipfile._WindowFile(fp, 2, 10, shared=True)
+            self.assertEqual(window.read(3), self.raw(2, 3))
+            self.assertEqual(window.seek(-4, 2), 6)
+            self.assertEqual(window.read(), self.raw(8, 4))
+            self.assertEqual(window.read(), b"")
+            self.assertRaises(IOError, window.seek, -11, 2)
+            window.close()
+            self.assertFalse(fp.closed)
+            self.assertRaises(ValueError, window.read)
+
+    def raw(self, offset, size):
+        with open(TESTFN, "rb") as fp:
+            fp.seek(offset)
+            return fp.read(size)
+
+    def test_not_a_zip(self):
+        with zipfile.ZipFile(TESTFN, "r") as zf:
+            self.assertRaises(zipfile.BadZipFile, zf.open_nested, "plain.txt")
+
+    def tearDown(self):
+        unlink(TESTFN)
+
+
+class ExtractAllTests(unittest.TestCase):
+    names = ["a.txt", "empty.txt", "dir/", "dir/b.txt",
+             "dir/sub/c.txt", "other/d.txt", "/absolute.txt"]
+
+    def setUp(self):
+        with zipfile.ZipFile(TESTFN, "w", zipfile.ZIP_DEFLATED) as zf:
+            for name in self.names:
+                zf.writestr(name, self.content(name))
+            # the later one wins
+            zf.writestr("a.txt", b"second")
+
+    def content(self, name):
+        if name.endswith("/") or name == "empty.txt":
+            return b""
+        return (name + "\n") * 10000
+
+    def check(self):
+        for name in self.names:
+            path = os.path.join(TESTFNDIR, name.lstrip("/"))
+            if name.endswith("/"):
+                self.assertTrue(os.path.isdir(path))
+            elif name == "a.txt":
+                with open(path, "rb") as fp:
+                    self.assertEqual(fp.read(), b"second")
+            else:
+                with open(path, "rb") as fp:
+                    self.assertEqual(fp.read(), self.content(name))
+
+    @unittest.skipIf(zipfile._fallocate is None, "requires posix_fallocate()")
+    def test_preallocate(self):
+        with open(TESTFN2, "wb") as fp:
+            zipfile._preallocate(fp, 1 << 20)
+        st = os.stat(TESTFN2)
+        unlink(TESTFN2)
+        self.assertEqual(st.st_size, 1 << 20)
+        if hasattr(st, "st_blocks"):
+            # the blocks are reserved, the file is not just sparse
+            self.assertGreaterEqual(st.st_blocks * 512, 1 << 20)
+
+    def test_parallel(self):
+        with zipfile.ZipFile(TESTFN, "r") as zf:
+            zf.extractall(TESTFNDIR, workers=4)
+        self.check()
+
+    def test_members(self):
+        with zipfile.ZipFile(TESTFN, "r") as zf:
+            zf.extractall(TESTFNDIR, members=["dir/sub/c.txt", zf.getinfo("other/d.txt")],
+                          workers=4)
+        self.assertEqual(sorted(os.listdir(TESTFNDIR)), ["dir", "other"])
+        self.assertTrue(os.path.isfile(os.path.join(TESTFNDIR, "dir", "sub", "c.txt")))
+
+    def test_file_object(self):
+        with open(TESTFN, "rb") as fp:
+            with zipfile.ZipFile(fp, "r") as zf:
+                zf.extractall(TESTFNDIR, workers=4)
+        self.check()
+
+    def test_bad_member(self):
+        with zipfile.ZipFile(TESTFN, "r") as zf:
+            offset = zf._resolve_data_offset(zf.getinfo("dir/b.txt"))
+        with open(TESTFN, "r+b") as fp:
+            fp.seek(offset + 20)
+            fp.write(b"\xff" * 4)
+        with zipfile.ZipFile(TESTFN, "r") as zf:
+            self.assertRaises(zipfile._CRC_ERRORS, zf.extractall, TESTFNDIR,
+                              workers=4)
+
+    def tearDown(self):
+        unlink(TESTFN)
+        if os.path.isdir(TESTFNDIR):
+            shutil.rmtree(TESTFNDIR)
+
+
+class IOHintsTests(unittest.TestCase):
+    def setUp(self):
+        self.advice = []
+        self.fds = []
+        self.fadvise = zipfile._fadvise
+        zipfile._fadvise = self.record
+        with zipfile.ZipFile(TESTFN, "w") as zf:
+            for x in range(3):
+                zf.writestr("file%d.txt" % x, b"%d" % x * 1000)
+
+    def record(self, fd, offset, length, advice):
+        self.assertIsInstance(fd, int)
+        self.advice.append((offset, length, advice))
+        self.fds.append(fd)
+
+    def advised(self, fd):
+        return [a for a, x in zip(self.advice, self.fds) if x == fd]
+
+    def assertScanned(self, zf, offset=0, shared=False):
+        # the readahead hints go to the handles, which are actually read
+        fd = zf.fp.fileno()
+        sequential = (offset, 0, zipfile._FADV_SEQUENTIAL)
+        if shared:
+            self.assertEqual(self.advised(fd)[0], sequential)
+            self.assertEqual(self.advised(fd)[-2:],
+                             [(offset, 0, zipfile._FADV_DONTNEED),
+                              (offset, 0, zipfile._FADV_NORMAL)])
+        else:
+            self.assertNotIn(sequential, self.advised(fd))
+            self.assertEqual(self.advised(fd)[-1],
+                             (offset, 0, zipfile._FADV_DONTNEED))
+            readers = [x for a, x in zip(self.advice, self.fds)
+                       if a == sequential and x != fd]
+            self.assertEqual(len(readers), len(zf.infolist()))
+
+    def assertReadAhead(self, zf):
+        for zinfo in zf.infolist():
+            self.assertIn((zinfo._data_offset, zinfo.compress_size,
+                           zipfile._FADV_WILLNEED), self.advice)
+
+    def test_disabled(self):
+        with zipfile.ZipFile(TESTFN, "r") as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(zf.verify(), [])
+        self.assertEqual(self.advice, [])
+
+    def test_testzip(self):
+        with zipfile.ZipFile(TESTFN, "r", io_hints=True,
+                             drop_cache=True) as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertScanned(zf)
+            self.assertReadAhead(zf)
+
+    def test_verify(self):
+        with zipfile.ZipFile(TESTFN, "r", io_hints=True,
+                             drop_cache=True) as zf:
+            self.assertEqual(zf.verify(workers=2), [])
+            self.assertScanned(zf)
+            self.assertReadAhead(zf)
+            # each batch is read ahead as a whole
+            batches = zf._verify_batches(zf.infolist(), 2)
+            for batch in batches:
+                self.assertIn(batch[0].header_offset,
+                              [offset for offset, length, advice
+                               in self.advised(zf.fp.fileno())
+                               if advice == zipfile._FADV_WILLNEED])
+
+    def test_extractall(self):
+        directory = TESTFN2 + "dir"
+        for workers in (1, 2):
+            del self.advice[:]
+            del self.fds[:]
+            with zipfile.ZipFile(TESTFN, "r", io_hints=True,
+                                 drop_cache=True) as zf:
+                zf.extractall(directory, workers=workers)
+                self.assertScanned(zf)
+            shutil.rmtree(directory)
+
+    def test_remove(self):
+        with zipfile.ZipFile(TESTFN, "a", io_hints=True,
+                             drop_cache=True) as zf:
+            offset = zf.getinfo("file1.txt").header_offset
+            zf.remove("file1.txt")
+            self.assertScanned(zf, offset, shared=True)
+        with zipfile.ZipFile(TESTFN, "r") as zf:
+            self.assertIsNone(zf.testzip())
+
+    def test_keep_cache(self):
+        # without drop_cache the pages of concurrent readers stay cached
+        with zipfile.ZipFile(TESTFN, "a", io_hints=True) as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(zf.verify(workers=2), [])
+            zf.remove("file1.txt")
+        self.assertTrue(self.advice)
+        self.assertNotIn(zipfile._FADV_DONTNEED,
+                         [advice for offset, length, advice in self.advice])
+
+    def test_drop_cache(self):
+        # dropping the pages does not need the readahead hints
+        with zipfile.ZipFile(TESTFN, "r", drop_cache=True) as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(self.advice, [(0, 0, zipfile._FADV_DONTNEED)])
+            self.assertEqual(self.fds, [zf.fp.fileno()])
+
+    def test_file_object(self):
+        # the shared file object is only read ahead
+        with io.open(TESTFN, "rb") as fp:
+            with zipfile.ZipFile(fp, "r", io_hints=True) as zf:
+                self.assertEqual(zf.read("file2.txt"), b"2" * 1000)
+                info = zf.getinfo("file2.txt")
+        self.assertEqual(self.advice, [(info._data_offset, info.compress_size,
+                                        zipfile._FADV_WILLNEED)])
+
+    def test_file_object_scanned(self):
+        # a pass over a file object reads through it, so it gets the hints
+        with io.open(TESTFN, "rb") as fp:
+            with zipfile.ZipFile(fp, "r", io_hints=True,
+                                 drop_cache=True) as zf:
+                self.assertIsNone(zf.testzip())
+                self.assertScanned(zf, shared=True)
+            self.assertEqual(set(self.fds), set([fp.fileno()]))
+
+    def test_unavailable(self):
+        for x, fadvise in enumerate((None, self.fadvise)):
+            zipfile._fadvise = fadvise
+            with zipfile.ZipFile(TESTFN, "a", io_hints=True,
+                                 drop_cache=True) as zf:
+                self.assertIsNone(zf.testzip())
+                zf.remove("file%d.txt" % x)
+                self.assertEqual(zf.verify(), [])
+        self.assertEqual(self.advice, [])
+
+    def tearDown(self):
+        zipfile._fadvise = self.fadvise
+        unlink(TESTFN)
+        unlink(TESTFN2)
+
+
+class IterMembersTests(unittest.TestCase):
+    def setUp(self):
+        with zipfile.ZipFile(TESTFN, "w") as zf:
+            for x in range(100):
+                zf.writestr("file%d.txt" % x, b"%d" % x * 100,
+                            (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED)[x % 2])
+            zf.writestr("large", b"large" * 10000)
+            zf.writestr("last", b"last")
+
+    def content(self, zinfo):
+        if zinfo.filename.startswith("file"):
+            return zinfo.filename[4:-4].encode("ascii") * 100
+        if zinfo.filename == "large":
+            return b"large" * 10000
+        return b"last"
+
+    def test_all(self):
+        with io.open(TESTFN, "rb") as fp:
+            counting = CountingFile(fp)
+            with zipfile.ZipFile(counting, "r") as zf:
+                counting.seeks = 0
+                result = list(zf.iter_members())
+                # a single read, except for the local header of the last one
+                self.assertLessEqual(counting.seeks, 3)
+                self.assertEqual([zinfo for zinfo, data in result],
+                                 zf.infolist())
+        for zinfo, data in result:
+            self.assertEqual(data, self.content(zinfo))
+
+    def test_chunks(self):
+        with zipfile.ZipFile(TESTFN, "r") as zf:
+            names = ["file%d.txt" % x for x in range(0, 100, 3)]
+            names += ["last", "large"]
+            result = list(zf.iter_members(names, max_chunk=1000))
+            self.assertEqual(sorted(zinfo.filename for zinfo, data in result),
+                             sorted(names))
+            offsets = [zinfo.header_offset for zinfo, data in result]
+            self.assertEqual(offsets, sorted(offsets))
+            for zinfo, data in result:
+                self.assertEqual(data, self.content(zinfo))
+            self.assertEqual(list(zf.iter_members([])), [])
+
+    def test_bad_crc(self):
+        with zipfile.ZipFile(TESTFN, "r") as zf:
+            offset = zf.getinfo("file10.txt").header_offset
+        with open(TESTFN, "r+b") as fp:
+            fp.seek(offset + 30 + len("file10.txt"))
+            fp.write(b"X")
+        with zipfile.ZipFile(TESTFN, "r") as zf:
+            self.assertRaises(zipfile.BadZipFile, list, zf.iter_members())
+        with zipfile.ZipFile(TESTFN, "r",
+                             verify_crc=zipfile.VERIFY_NEVER) as zf:
+            self.assertEqual(len(list(zf.iter_members())), 102)
+
+    def test_closed(self):
+        zf = zipfile.ZipFile(TESTFN, "r")
+        zf.close()
+        self.assertRaises(RuntimeError, list, zf.iter_members())
+
+    def tearDown(self):
+        unlink(TESTFN)
+
+
+class NameIndexTests(unittest.TestCase):
+    names = ["a.txt", "dir/", "dir/b.txt", "dir/sub/c.xml", "dir/sub/d.txt",
+             "other/e.xml"]
+
+    def setUp(self):
+        with zipfile.ZipFile(TESTFN, "w") as zf:
+            for name in self.names:
+                zf.writestr(name, b"")
+
+    def test_contains(self):
+        with zipfile.ZipFile(TESTFN, "r") as zf:
+            self.assertIn("dir/sub/c.xml", zf)
+            self.assertNotIn("dir/sub", zf)
+
+    def test_list_dir(self):
+        with zipfile.ZipFile(TESTFN, "r") as zf:
+            self.assertEqual(zf.list_dir(), ["a.txt", "dir/", "other/"])
+            self.assertEqual(zf.list_dir("dir"), ["b.txt", "sub/"])
+            self.assertEqual(zf.list_dir("dir/sub/"), ["c.xml", "d.txt"])
+            self.assertRaises(KeyError, zf.list_dir, "a.txt")
+            self.assertRaises(KeyError, zf.list_dir, "missing")
+
+    def test_walk(self):
+        with zipfile.ZipFile(TESTFN, "r") as zf:
+            self.assertEqual(list(zf.walk()), [
+                ("", ["dir", "other"], ["a.txt"]),
+                ("dir/", ["sub"], ["b.txt"]),
+                ("dir/sub/", [], ["c.xml", "d.txt"]),
+                ("other/", [], ["e.xml"])])
+            self.assertEqual(list(zf.walk("other")), [("other/", [], ["e.xml"])])
+            self.assertEqual(list(zf.walk("missing")), [])
+
+    def test_glob(self):
+        with zipfile.ZipFile(TESTFN, "r") as zf:
+            self.assertEqual(zf.glob("*.txt"), ["a.txt"])
+            self.assertEqual(zf.glob("*/*.xml"), ["other/e.xml"])
+            self.assertEqual(zf.glob("dir/*/*.xml"), ["dir/sub/c.xml"])
+            self.assertEqual(zf.glob("*"), ["a.txt", "dir/", "other/"])
+            self.assertEqual(zf.glob("d*/"), ["dir/"])
+            self.assertEqual(zf.glob("dir/s?b/[cd].*"),
+                             ["dir/sub/c.xml", "dir/sub/d.txt"])
+            self.assertEqual(zf.glob("nothing/*"), [])
+
+    def test_incremental(self):
+        with zipfile.ZipFile(TESTFN, "a") as zf:
+            self.assertEqual(zf.list_dir("other"), ["e.xml"])
+            zf.writestr("other/new.xml", b"new")
+            with open(TESTFN2, "wb") as fp:
+                fp.write(b"data")
+            zf.write(TESTFN2, "third/data.bin")
+            self.assertEqual(zf.list_dir("other"), ["e.xml", "new.xml"])
+            self.assertEqual(zf.glob("third/*"), ["third/data.bin"])
+
+            zf.remove("other/e.xml")
+            zf.remove("other/new.xml")
+            # the directory disappears along with its last member
+            self.assertEqual(zf.list_dir(), ["a.txt", "dir/", "third/"])
+            self.assertNotIn("other/new.xml", zf)
+
+            zf.rename("dir/sub/c.xml", "c.xml")
+            self.assertEqual(zf.list_dir("dir/sub"), ["d.txt"])
+            self.assertIn("c.xml", zf.list_dir())
+
+            # the explicit directory member stays
+            zf.remove("dir/b.txt")
+            zf.remove("dir/sub/d.txt")
+            self.assertEqual(zf.list_dir("dir"), [])
+            zf.remove("dir/")
+            self.assertRaises(KeyError, zf.list_dir, "dir")
+
+    def test_duplicates(self):
+        # the name stays as long as one of its members does
+        with zipfile.ZipFile(TESTFN, "a") as zf:
+            zf.writestr("dir/b.txt", b"second")
+            zf.writestr("dir/b.txt", b"third")
+            self.assertEqual(zf.list_dir("dir"), ["b.txt", "sub/"])
+            zf.remove(zf.infolist()[-1])
+            self.assertIn("dir/b.txt", zf)
+            self.assertEqual(zf.read("dir/b.txt"), b"second")
+            self.assertEqual(zf.list_dir("dir"), ["b.txt", "sub/"])
+            zf.rename(zf.getinfo("dir/b.txt"), "dir/c.txt")
+            self.assertEqual(zf.read("dir/b.txt"), b"")
+            self.assertEqual(zf.list_dir("dir"), ["b.txt", "c.txt", "sub/"])
+            zf.remove("dir/b.txt")
+            self.assertNotIn("dir/b.txt", zf)
+            self.assertEqual(zf.list_dir("dir"), ["c.txt", "sub/"])
+        with zipfile.ZipFile(TESTFN, "r") as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(zf.namelist().count("dir/b.txt"), 0)
+            self.assertEqual(zf.read("dir/c.txt"), b"second")
+
+    def test_remove_many(self):
+        # removed members are dropped from the file list in one pass
+        with zipfile.ZipFile(TESTFN, "a", reuse_space=True) as zf:
+            for x in range(100):
+                zf.writestr("many/%d.txt" % x, b"%d" % x)
+            for name in zf.glob("many/*"):
+                zf.remove(name)
+            self.assertEqual(len(zf._dropped), 100)
+            self.assertEqual(zf.namelist(), self.names)
+            self.assertEqual(zf._dropped, set())
+            self.assertRaises(KeyError, zf.list_dir, "many")
+        with zipfile.ZipFile(TESTFN, "r") as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(zf.namelist(), self.names)
+
+    def tearDown(self):
+        unlink(TESTFN)
+        unlink(TESTFN2)
+
+
+class SharedReadTests(unittest.TestCase):
+    def setUp(self):
+        with zipfile.ZipFile(TESTFN, "w") as zf:
+            for x in range(10):
+                zf.writestr("file%d.txt" % x, b"%d" % x * 100)
+
+    def test_shared_file_untouched(self):
+        with zipfile.ZipFile(TESTFN, "r") as zf:
+            position = zf.fp.tell()
+            for zinfo in zf.infolist():
+                self.assertEqual(bytes(zf.mmap(zinfo)), zf.read(zinfo))
+            self.assertEqual(len(list(zf.iter_members())), 10)
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(zf.fp.tell(), position)
+
+    @unittest.skipUnless(hasattr(os, "fork"), "requires os.fork()")
+    def test_fork_deferred(self):
+        with zipfile.ZipFile(TESTFN, "r",
+                             verify_crc=zipfile.VERIFY_DEFERRED) as zf:
+            zf.read("file0.txt")
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    # the verifier starts a thread in the child
+                    for x in range(10):
+                        zf.read("file%d.txt" % x)
+                    zf._verifier.wait()
+                    if zf._verifier._pid == os.getpid() and \
+                            not zf._verifier.pop_errors():
+                        status = 0
+                finally:
+                    os._exit(status)
+            self.assertEqual(os.waitpid(pid, 0)[1], 0)
+
+    def test_read_then_write(self):
+        # reading from a given file object keeps the position for writing
+        with open(TESTFN, "rb") as fp:
+            buffer = io.BytesIO(fp.read())
+        with zipfile.ZipFile(buffer, "a") as zf:
+            with zf.open("file1.txt") as member:
+                zf.writestr("new.txt", b"new")
+                self.assertEqual(member.read(), b"1" * 100)
+            self.assertEqual(len(list(zf.iter_members())), 11)
+            self.assertEqual(zf.read("file2.txt"), b"2" * 100)
+            zf.writestr("last.txt", b"last")
+        with zipfile.ZipFile(buffer, "r") as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(len(zf.namelist()), 12)
+
+    def tearDown(self):
+        unlink(TESTFN)
+
+
+class CopyFromTests(unittest.TestCase):
+    def setUp(self):
+        with zipfile.ZipFile(TESTFN, "w") as zf:
+            for x in range(20):
+                zf.writestr("file%d.txt" % x, b"%d" % x * 1000,
+                            (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED)[x % 2])
+            zf.writestr("aligned", b"aligned" * 1000, align=4096)
+
+    def copy(self, **kwargs):
+        progress = []
+        with zipfile.ZipFile(TESTFN, "r") as src, \
+                zipfile.ZipFile(TESTFN2, "w") as zf:
+            copied = zf.copy_from(src, progress=lambda done, total:
+                                  progress.append((done, total)), **kwargs)
+            self.assertEqual([zinfo.filename for zinfo in copied],
+                             src.namelist())
+        self.assertEqual(progress, [(x, 21) for x in range(1, 22)])
+
+    def check(self, compress_type=None):
+        with zipfile.ZipFile(TESTFN, "r") as src, \
+                zipfile.ZipFile(TESTFN2, "r") as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(zf.namelist(), src.namelist())
+            for zinfo in src.infolist():
+                copy = zf.getinfo(zinfo.filename)
+                self.assertEqual(zf.read(copy), src.read(zinfo))
+                self.assertEqual(copy.compress_type,
+                                 zinfo.compress_type if compress_type is None
+                                 else compress_type)
+            if zf.getinfo("aligned").compress_type == zipfile.ZIP_STORED:
+                self.assertEqual(zf._resolve_data_offset(
+                                 zf.getinfo("aligned")) % 4096, 0)
+
+    def test_raw(self):
+        self.copy()
+        self.check()
+
+    def test_recompress(self):
+        for compress_type in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            for workers, max_buffer in ((1, None), (4, None), (4, 2500)):
+                self.copy(compress_type=compress_type, workers=workers,
+                          max_buffer=max_buffer)
+                self.check(compress_type)
+
+    def test_file_object(self):
+        with io.open(TESTFN, "rb") as fp, zipfile.ZipFile(fp, "r") as src, \
+                zipfile.ZipFile(TESTFN2, "w") as zf:
+            zf.copy_from(src, ["file3.txt", "file2.txt"],
+                         compress_type=zipfile.ZIP_DEFLATED, workers=4)
+        with zipfile.ZipFile(TESTFN2, "r") as zf:
+            self.assertEqual(zf.namelist(), ["file2.txt", "file3.txt"])
+            self.assertEqual(zf.read("file2.txt"), b"2" * 1000)
+
+    def test_no_check(self):
+        # raw copies are not decompressed, so a bad CRC is copied as well
+        with zipfile.ZipFile(TESTFN, "r") as zf:
+            offset = zf._resolve_data_offset(zf.getinfo("file4.txt"))
+        with open(TESTFN, "r+b") as fp:
+            fp.seek(offset)
+            fp.write(b"X")
+        with zipfile.ZipFile(TESTFN, "r") as src, \
+                zipfile.ZipFile(TESTFN2, "w") as zf:
+            zf.copy_from(src)
+            self.assertRaises(zipfile.BadZipFile, zf.copy_from, src,
+                              ["file4.txt"], zipfile.ZIP_DEFLATED)
+        with zipfile.ZipFile(TESTFN2, "r") as zf:
+            self.assertEqual(zf.testzip(), "file4.txt")
+
+    def test_bad_type(self):
+        with zipfile.ZipFile(TESTFN, "r") as src, \
+                zipfile.ZipFile(TESTFN2, "w") as zf:
+            self.assertRaises(RuntimeError, zf.copy_from, src,
+                              compress_type=-1)
+
+    def tearDown(self):
+        unlink(TESTFN)
+        unlink(TESTFN2)
+
+
 def test_main():
     run_unittest(TestsWithSourceFile, TestZip64InSmallFiles, OtherTests,
                  PyZipFileTests, DecryptionTests, TestsWithMultipleOpens,
                  TestWithDirectory, UniversalNewlineTests,
-                 TestsWithRandomBinaryFiles, RemoveTests)
+                 TestsWithRandomBinaryFiles, RemoveTests, DataOffsetTests,
+                 FreeSpaceTests, ReplaceTests, RenameTests, DurabilityTests, VerifyTests,
+                 VerifyPolicyTests, FlushPolicyTests, AlignmentTests,
+                 NestedTests, ExtractAllTests, IOHintsTests,
+                 IterMembersTests, NameIndexTests, SharedReadTests,
+                 CopyFromTests)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,141 @@
+"""
+Tests of ZIP64 archives with real large files and many members.
+They need about 10 GB of free disk space and take some minutes, so they only
+run if the environment variable PYCOMBINEARCHIVE_LARGE_TESTS is set.
+"""
+import os
+import time
+import resource
+import unittest
+import combinearchive.custom_zip as zipfile
+
+from unittest import skipUnless
+
+from tests.custom_support import TESTFN, run_unittest, unlink
+from combinearchive import combinearchive
+
+TESTFN2 = TESTFN + "2"
+LARGE_SIZE = (1 << 32) + (1 << 29)      # 4.5 GB, more than 32 bit can hold
+MANY_MEMBERS = (1 << 16) + 1000
+MEMORY_LIMIT = 256 * 1024               # peak memory growth in KB
+
+requires_large = skipUnless(os.environ.get("PYCOMBINEARCHIVE_LARGE_TESTS"),
+                            "set PYCOMBINEARCHIVE_LARGE_TESTS to run tests with large archives")
+
+
+def max_rss():
+    """peak resident memory of this process in KB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+@requires_large
+class LargeFileTests(unittest.TestCase):
+
+    def setUp(self):
+        # sparse source file, so only the archive takes disk space
+        with open(TESTFN, "wb") as fp:
+            fp.truncate(LARGE_SIZE)
+
+    def report(self, action, size, start):
+        duration = time.time() - start
+        print("\n{}: {:.1f} MB/s".format(action, size / duration / (1 << 20)))
+
+    def test_write_read(self):
+        rss = max_rss()
+        start = time.time()
+        with zipfile.ZipFile(TESTFN2, "w") as zf:
+            zf.writestr("before", b"before")
+            zf.write(TESTFN, "large")
+            zf.writestr("after", b"after")
+        self.report("write", LARGE_SIZE, start)
+
+        start = time.time()
+        with zipfile.ZipFile(TESTFN2, "r") as zf:
+            zinfo = zf.getinfo("large")
+            self.assertEqual(zinfo.file_size, LARGE_SIZE)
+            self.assertGreater(zf.getinfo("after").header_offset, zipfile.ZIP64_LIMIT)
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(zf.read("after"), b"after")
+        self.report("read", LARGE_SIZE, start)
+        self.assertLess(max_rss() - rss, MEMORY_LIMIT)
+
+    def test_remove_behind_limit(self):
+        with zipfile.ZipFile(TESTFN2, "w") as zf:
+            zf.write(TESTFN, "large")
+            zf.writestr("first", b"first")
+            zf.writestr("second", b"second")
+
+        rss = max_rss()
+        with zipfile.ZipFile(TESTFN2, "a") as zf:
+            zf.remove("first")
+            zf.writestr("third", b"third")
+
+        with zipfile.ZipFile(TESTFN2, "r") as zf:
+            self.assertEqual(zf.namelist(), ["large", "second", "third"])
+            self.assertEqual(zf.read("second"), b"second")
+            self.assertEqual(zf.read("third"), b"third")
+        self.assertLess(max_rss() - rss, MEMORY_LIMIT)
+
+    def test_remove_in_front(self):
+        with zipfile.ZipFile(TESTFN2, "w") as zf:
+            zf.writestr("first", b"first")
+            zf.write(TESTFN, "large")
+            zf.writestr("last", b"last")
+
+        # the large member is moved in chunks
+        rss = max_rss()
+        start = time.time()
+        with zipfile.ZipFile(TESTFN2, "a") as zf:
+            zf.remove("first")
+        self.report("remove", LARGE_SIZE, start)
+        self.assertLess(max_rss() - rss, MEMORY_LIMIT)
+
+        with zipfile.ZipFile(TESTFN2, "r") as zf:
+            self.assertEqual(zf.getinfo("large").header_offset, 0)
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(zf.read("last"), b"last")
+
+    def tearDown(self):
+        unlink(TESTFN)
+        unlink(TESTFN2)
+
+
+@requires_large
+class ManyMembersTests(unittest.TestCase):
+
+    def test_zipfile(self):
+        with zipfile.ZipFile(TESTFN2, "w") as zf:
+            for x in range(MANY_MEMBERS):
+                zf.writestr("%d.txt" % x, b"%d" % x)
+
+        with zipfile.ZipFile(TESTFN2, "a") as zf:
+            self.assertEqual(len(zf.namelist()), MANY_MEMBERS)
+            zf.remove("0.txt")
+
+        with zipfile.ZipFile(TESTFN2, "r") as zf:
+            self.assertEqual(len(zf.namelist()), MANY_MEMBERS - 1)
+            self.assertEqual(zf.read("%d.txt" % (MANY_MEMBERS - 1)), b"%d" % (MANY_MEMBERS - 1))
+
+    def test_archive_repack(self):
+        archive = combinearchive.CombineArchive(TESTFN2)
+        for x in range(MANY_MEMBERS):
+            archive.add_entry(b"%d" % x, "text/plain", "%d.txt" % x)
+        archive.pack()
+        archive.repack()
+        archive.close()
+
+        archive = combinearchive.CombineArchive(TESTFN2)
+        self.assertEqual(archive.get_entry("%d.txt" % (MANY_MEMBERS - 1)).read(), b"%d" % (MANY_MEMBERS - 1))
+        self.assertIsNone(archive._zip.testzip())
+        archive.close()
+
+    def tearDown(self):
+        unlink(TESTFN2)
+
+
+def test_main():
+    run_unittest(LargeFileTests, ManyMembersTests)
+
+
+if __name__ == "__main__":
+    test_main()